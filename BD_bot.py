@@ -1,18 +1,51 @@
 import os
 import io
+import sys
 import re
+import json
+import codecs
+import sqlite3
+import argparse
+import threading
+import gzip
+import glob
+import time
 import asyncio
+import heapq
+import array
+import bisect
+import difflib
+import shlex
+import secrets
+import functools
+import importlib
+import contextlib
+import contextvars
+import math
+import multiprocessing
+from collections import Counter, OrderedDict, deque
+from itertools import zip_longest
+from dataclasses import dataclass, field
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from dotenv import load_dotenv
-import asyncpg
 import logging
-import subprocess
-import paramiko
-from paramiko import AutoAddPolicy
-from telegram import Update, ReplyKeyboardRemove
+import logging.handlers
+import atexit
+import copy
+import queue
+from telegram.request import BaseRequest, HTTPXRequest
+from telegram import Update, ReplyKeyboardRemove, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.helpers import escape_markdown
+from telegram.error import Forbidden, TelegramError
 from telegram.ext import (
+    Application,
     ApplicationBuilder,
     ContextTypes,
     CommandHandler,
+    CallbackQueryHandler,
+    TypeHandler,
+    BasePersistence,
+    PersistenceInput,
     MessageHandler,
     ConversationHandler,
     filters,
@@ -33,15 +66,278 @@ DB_HOST = os.getenv("DB_HOST")
 DB_PORT = int(os.getenv("DB_PORT", 5432))
 DB_DATABASE = os.getenv("DB_DATABASE")
 
+# Режим получения обновлений: polling или webhook
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+# Обработчики дешевы в ожидании: тяжелую работу ограничивает ADMISSION_LIMIT
+BOT_WORKERS = int(os.getenv("BOT_WORKERS", 64))
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "127.0.0.1")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", 8443))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", 40))
+
+# Параметры пула соединений с базой данных
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", 1))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", 10))
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", 100))
+DB_COMMAND_TIMEOUT = float(os.getenv("DB_COMMAND_TIMEOUT", 30))
+DB_PAGE_SIZE = int(os.getenv("DB_PAGE_SIZE", 30))
+DB_EXPORT_CHUNK_SIZE = int(os.getenv("DB_EXPORT_CHUNK_SIZE", 1000))
+DB_BULK_THRESHOLD = int(os.getenv("DB_BULK_THRESHOLD", 1000))
+# Сколько последних сообщений с постраничным выводом помнит каждый пользователь
+DB_PAGES_KEPT = int(os.getenv("DB_PAGES_KEPT", 20))
+
+# Инвентарь хостов и параметры параллельного опроса
+HOSTS_FILE = os.getenv("HOSTS_FILE", "hosts.json")
+FLEET_CONCURRENCY = int(os.getenv("FLEET_CONCURRENCY", 10))
+FLEET_HOST_TIMEOUT = float(os.getenv("FLEET_HOST_TIMEOUT", 30))
+
+# Параметры пула SSH-соединений
+SSH_MAX_CHANNELS = int(os.getenv("SSH_MAX_CHANNELS", 8))
+SSH_CONNECT_TIMEOUT = float(os.getenv("SSH_CONNECT_TIMEOUT", 10))
+SSH_COMMAND_TIMEOUT = float(os.getenv("SSH_COMMAND_TIMEOUT", 60))
+SSH_KEEPALIVE = int(os.getenv("SSH_KEEPALIVE", 30))
+SSH_RECONNECT_ATTEMPTS = int(os.getenv("SSH_RECONNECT_ATTEMPTS", 3))
+SSH_RECONNECT_BACKOFF = float(os.getenv("SSH_RECONNECT_BACKOFF", 0.5))
+
+# Пул потоков для неизбежно блокирующих вызовов (paramiko, файловый ввод-вывод)
+BLOCKING_WORKERS = int(os.getenv("BLOCKING_WORKERS", 16))
+
+# Параметры поиска совпадений в больших текстах и документах
+EXTRACT_CHUNK_SIZE = int(os.getenv("EXTRACT_CHUNK_SIZE", 1024 * 1024))
+EXTRACT_OVERLAP = int(os.getenv("EXTRACT_OVERLAP", 1024))
+EXTRACT_PROCESS_THRESHOLD = int(os.getenv("EXTRACT_PROCESS_THRESHOLD", 2 * 1024 * 1024))
+EXTRACT_PROCESSES = int(os.getenv("EXTRACT_PROCESSES", os.cpu_count() or 1))
+# Bot API позволяет скачивать файлы размером до 20 МБ
+EXTRACT_MAX_FILE_SIZE = int(os.getenv("EXTRACT_MAX_FILE_SIZE", 20 * 1024 * 1024))
+
+# Хранение состояний диалогов и user_data между перезапусками (пустой путь - без хранения)
+PERSISTENCE_PATH = os.getenv("PERSISTENCE_PATH", "bot_state.sqlite3")
+PERSISTENCE_UPDATE_INTERVAL = float(os.getenv("PERSISTENCE_UPDATE_INTERVAL", 30))
+PERSISTENCE_WRITE_DELAY = float(os.getenv("PERSISTENCE_WRITE_DELAY", 1))
+CONVERSATION_TIMEOUT = float(os.getenv("CONVERSATION_TIMEOUT", 600))
+USER_DATA_TTL = float(os.getenv("USER_DATA_TTL", 3600))
+USER_DATA_SWEEP_INTERVAL = float(os.getenv("USER_DATA_SWEEP_INTERVAL", 300))
+
+# Параметры кэша результатов удаленных команд (время жизни в секундах)
+CACHE_TTL_LONG = int(os.getenv("CACHE_TTL_LONG", 3600))
+CACHE_TTL_MEDIUM = int(os.getenv("CACHE_TTL_MEDIUM", 60))
+CACHE_TTL_SHORT = int(os.getenv("CACHE_TTL_SHORT", 5))
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", 256))
+
+# Пороги (предупреждение, авария) для сводки /get_health
+HEALTH_THRESHOLDS = {
+    'cpu': (float(os.getenv("HEALTH_CPU_WARN", 80)), float(os.getenv("HEALTH_CPU_CRIT", 95))),
+    'load': (float(os.getenv("HEALTH_LOAD_WARN", 1.0)), float(os.getenv("HEALTH_LOAD_CRIT", 2.0))),
+    'mem': (float(os.getenv("HEALTH_MEM_WARN", 80)), float(os.getenv("HEALTH_MEM_CRIT", 90))),
+    'swap': (float(os.getenv("HEALTH_SWAP_WARN", 50)), float(os.getenv("HEALTH_SWAP_CRIT", 80))),
+    'disk': (float(os.getenv("HEALTH_DISK_WARN", 80)), float(os.getenv("HEALTH_DISK_CRIT", 90))),
+}
+HEALTH_CPU_SAMPLE = float(os.getenv("HEALTH_CPU_SAMPLE", 0.5))
+
+# Фоновый опрос хостов (0 - выключен) и оповещения по порогам HEALTH_THRESHOLDS.
+# Опрашиваются только хосты из MONITOR_HOSTS, на которые подписан хотя бы один чат
+MONITOR_INTERVAL = float(os.getenv("MONITOR_INTERVAL", 0))
+MONITOR_HOSTS = [selector for selector in os.getenv("MONITOR_HOSTS", "all").split(',') if selector]
+MONITOR_HISTORY = int(os.getenv("MONITOR_HISTORY", 120))
+MONITOR_MAX_AGE = float(os.getenv("MONITOR_MAX_AGE", 2 * MONITOR_INTERVAL))
+# Доля порога, на которую значение должно опуститься ниже него, чтобы оповещение снялось
+ALERT_HYSTERESIS = float(os.getenv("ALERT_HYSTERESIS", 0.05))
+# Скорость роста (процентных пунктов в час) за окно ALERT_RATE_WINDOW секунд
+ALERT_RATE_RULES = {
+    'disk': float(os.getenv("ALERT_DISK_RATE", 10)),
+    'mem': float(os.getenv("ALERT_MEM_RATE", 30)),
+}
+ALERT_RATE_WINDOW = float(os.getenv("ALERT_RATE_WINDOW", 900))
+ALERT_REPEAT_INTERVAL = float(os.getenv("ALERT_REPEAT_INTERVAL", 3600))
+
+# Ограничение частоты запросов: (емкость корзины, пополнение в токенах за секунду)
+# по классам команд; стоимость обработчика по умолчанию - 1 токен
+RATE_LIMITS = {
+    'ssh': (float(os.getenv("RATE_SSH_BURST", 10)), float(os.getenv("RATE_SSH_RATE", 0.5))),
+    'db': (float(os.getenv("RATE_DB_BURST", 10)), float(os.getenv("RATE_DB_RATE", 1))),
+    'cpu': (float(os.getenv("RATE_CPU_BURST", 5)), float(os.getenv("RATE_CPU_RATE", 0.2))),
+}
+RATE_COSTS = {
+    'get_mpstat': 3, 'get_health': 3, 'get_critical': 2, 'get_auths': 2,
+    'apt_list_all': 2, 'apt_package_search': 2, 'get_repl_logs': 2,
+    'receive_emails_document': 3, 'receive_phones_document': 3,
+    **json.loads(os.getenv("RATE_COSTS", "{}")),
+}
+RATE_MAX_BUCKETS = int(os.getenv("RATE_MAX_BUCKETS", 10000))
+
+# Общее ограничение одновременных SSH/DB-операций и очередь ожидания
+ADMISSION_LIMIT = int(os.getenv("ADMISSION_LIMIT", 8))
+ADMISSION_QUEUE = int(os.getenv("ADMISSION_QUEUE", 16))
+ADMISSION_WAIT_TIMEOUT = float(os.getenv("ADMISSION_WAIT_TIMEOUT", 10))
+
+# Метрики: администраторы для /bot_stats и необязательный HTTP-эндпоинт /metrics
+ADMIN_IDS = {int(user_id) for user_id in os.getenv("ADMIN_IDS", "").split(',') if user_id.strip()}
+METRICS_LISTEN = os.getenv("METRICS_LISTEN", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", 0))
+
+# Журнал PostgreSQL, из которого выбираются записи о репликации
+REPL_LOG_PATH = os.getenv("REPL_LOG_PATH", "/var/log/postgresql/postgresql.log")
+REPL_LOG_PATTERN = re.compile(os.getenv("REPL_LOG_PATTERN", "repl").encode('utf-8'))
+REPL_LOG_LINES = int(os.getenv("REPL_LOG_LINES", 15))
+REPL_LOG_MAX_LINES = int(os.getenv("REPL_LOG_MAX_LINES", 200))
+REPL_LOG_BLOCK_SIZE = int(os.getenv("REPL_LOG_BLOCK_SIZE", 64 * 1024))
+REPL_FOLLOW_INTERVAL = float(os.getenv("REPL_FOLLOW_INTERVAL", 5))
+REPL_FOLLOW_MAX_BYTES = int(os.getenv("REPL_FOLLOW_MAX_BYTES", 1024 * 1024))
+
+# Доставка длинных ответов: страницы с навигацией, выше порога - сжатый документ
+REPLY_PAGE_SIZE = int(os.getenv("REPLY_PAGE_SIZE", 3800))
+REPLY_DOCUMENT_THRESHOLD = int(os.getenv("REPLY_DOCUMENT_THRESHOLD", 64 * 1024))
+OUTPUT_CACHE_ENTRIES = int(os.getenv("OUTPUT_CACHE_ENTRIES", 128))
+OUTPUT_CACHE_CHARS = int(os.getenv("OUTPUT_CACHE_CHARS", 16 * 1024 * 1024))
+
+# Журнал бота: ротация по размеру или по времени (LOG_ROTATE_WHEN, например midnight),
+# формат text или json
+LOG_FILE = os.getenv("LOG_FILE", "bot.log")
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", 10 * 1024 * 1024))
+LOG_ROTATE_WHEN = os.getenv("LOG_ROTATE_WHEN")
+LOG_BACKUP_COUNT = int(os.getenv("LOG_BACKUP_COUNT", 10))
+
+# Индекс установленных пакетов, построенный по базе dpkg удаленного хоста
+PACKAGE_STATUS_PATH = os.getenv("PACKAGE_STATUS_PATH", "/var/lib/dpkg/status")
+PACKAGE_CHECK_INTERVAL = float(os.getenv("PACKAGE_CHECK_INTERVAL", 60))
+PACKAGE_PAGE_SIZE = int(os.getenv("PACKAGE_PAGE_SIZE", 30))
+PACKAGE_FUZZY_LIMIT = int(os.getenv("PACKAGE_FUZZY_LIMIT", 10))
+PACKAGE_FUZZY_CUTOFF = float(os.getenv("PACKAGE_FUZZY_CUTOFF", 0.6))
+
 # Настройка логгирования
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO,
-    filename='bot.log',
-    filemode='a'  # Можно установить 'w' для перезаписи лога при каждом запуске
-)
+# Обработчик и пользователь, от имени которых выполняется текущая задача
+current_handler = contextvars.ContextVar('current_handler', default='background')
+current_user = contextvars.ContextVar('current_user', default=None)
+
+
+def compress_rotated_log(source, dest):
+    """Ротатор: сжимает закрытую часть журнала в gzip (выполняется в потоке QueueListener)."""
+    with open(source, 'rb') as src, gzip.open(dest, 'wb') as dst:
+        while chunk := src.read(1024 * 1024):
+            dst.write(chunk)
+    os.remove(source)
+
+
+class LogContextFilter(logging.Filter):
+    """Добавляет к записи пользователя и команду из контекста текущего обновления."""
+
+    def filter(self, record):
+        if not hasattr(record, 'user_id'):
+            record.user_id = current_user.get()
+        if not hasattr(record, 'command'):
+            record.command = current_handler.get()
+        return True
+
+
+class ContextQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler, сохраняющий трассировку отдельно от сообщения, чтобы форматтер
+    в потоке записи мог вывести ее в своем формате."""
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class JsonLogFormatter(logging.Formatter):
+    """Одна JSON-строка на запись: время, уровень, сообщение, user_id, command, duration_ms."""
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record, '%Y-%m-%dT%H:%M:%S') + f'.{int(record.msecs):03d}',
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'user_id': getattr(record, 'user_id', None),
+            'command': getattr(record, 'command', None),
+        }
+        if hasattr(record, 'duration_ms'):
+            entry['duration_ms'] = record.duration_ms
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False)
+
+
+def setup_logging():
+    """Записи попадают в очередь, а запись на диск, ротация и сжатие выполняются
+    в отдельном потоке QueueListener, не блокируя цикл событий."""
+    if LOG_ROTATE_WHEN:
+        file_handler = logging.handlers.TimedRotatingFileHandler(
+            LOG_FILE, when=LOG_ROTATE_WHEN, backupCount=LOG_BACKUP_COUNT, encoding='utf-8'
+        )
+    else:
+        file_handler = logging.handlers.RotatingFileHandler(
+            LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding='utf-8'
+        )
+    file_handler.namer = lambda name: name + '.gz'
+    file_handler.rotator = compress_rotated_log
+    if LOG_FORMAT == 'json':
+        file_handler.setFormatter(JsonLogFormatter())
+    else:
+        file_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = ContextQueueHandler(log_queue)
+    queue_handler.addFilter(LogContextFilter())
+    root = logging.getLogger()
+    root.setLevel(LOG_LEVEL)
+    root.addHandler(queue_handler)
+    listener = logging.handlers.QueueListener(log_queue, file_handler, respect_handler_level=True)
+    listener.start()
+    # Дописываем оставшиеся в очереди записи при завершении процесса
+    atexit.register(listener.stop)
+    return listener
+
+
+log_listener = setup_logging()
 logger = logging.getLogger(__name__)
 
+# SQL-запросы. asyncpg кэширует подготовленные выражения на каждом соединении пула
+# (statement_cache_size), поэтому каждый запрос подготавливается один раз на соединение.
+# Небольшие пачки вставляются одним запросом с массивом, крупные - через COPY во временную таблицу.
+SQL_INSERT_ARRAY = 'INSERT INTO {table}({column}) SELECT DISTINCT unnest($1::text[]) ON CONFLICT DO NOTHING'
+SQL_CREATE_STAGING = 'CREATE TEMP TABLE contact_staging (value text) ON COMMIT DROP'
+SQL_INSERT_STAGING = 'INSERT INTO {table}({column}) SELECT DISTINCT value FROM contact_staging ON CONFLICT DO NOTHING'
+
+# Таблицы для постраничного вывода. Навигация по ключу (keyset) вместо OFFSET,
+# чтобы стоимость перехода не зависела от номера страницы.
+CONTACT_TABLES = {
+    'emails': {
+        'table': 'emails',
+        'column': 'email',
+        'title': 'Список email-адресов',
+        'empty': 'Таблица email-адресов пуста.',
+        'error': 'Ошибка при получении email-адресов',
+        'queries': {
+            'first': 'SELECT email FROM emails ORDER BY email LIMIT $1',
+            'next': 'SELECT email FROM emails WHERE email > $1 ORDER BY email LIMIT $2',
+            'prev': 'SELECT email FROM emails WHERE email < $1 ORDER BY email DESC LIMIT $2',
+            'all': 'SELECT email FROM emails ORDER BY email',
+        },
+    },
+    'phones': {
+        'table': 'phones',
+        'column': 'phone_number',
+        'title': 'Список номеров телефонов',
+        'empty': 'Таблица номеров телефонов пуста.',
+        'error': 'Ошибка при получении номеров телефонов',
+        'queries': {
+            'first': 'SELECT phone_number FROM phones ORDER BY phone_number LIMIT $1',
+            'next': 'SELECT phone_number FROM phones WHERE phone_number > $1 ORDER BY phone_number LIMIT $2',
+            'prev': 'SELECT phone_number FROM phones WHERE phone_number < $1 ORDER BY phone_number DESC LIMIT $2',
+            'all': 'SELECT phone_number FROM phones ORDER BY phone_number',
+        },
+    },
+}
+
 # Состояния для ConversationHandler
 GET_EMAILS_TEXT, CONFIRM_EMAIL, GET_PHONES_TEXT, CONFIRM_PHONE, VERIFY_PASSWORD, APT_LIST_CHOICE, APT_PACKAGE_NAME = range(7)
 
@@ -60,124 +356,1748 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Отправляет сообщение при вводе команды /start."""
     user = update.effective_user
     await update.message.reply_markdown_v2(
-        fr'Привет {user.mention_markdown_v2()}\! Я готов помочь\. Вот доступные команды:\n'
-        '/start - Запуск Бота\n'
-        '/cancel - Отмена\n'
-        '/find_phone_numbers - Поиск телефонных номеров в тексте\n'
-        '/find_email_address - Поиск Email адресов в тексте\n'
-        '/verify_password - Проверка сложности пароля\n'
-        '/get_release - Информация о релизе\n'
-        '/get_uname - Информация об архитектуре процессора, имени хоста системы и версии ядра\n'
-        '/get_uptime - Информация о времени работы\n'
-        '/get_df - Информация о состоянии файловой системы\n'
-        '/get_free - Информация о состоянии оперативной памяти\n'
-        '/get_mpstat - Информация о производительности системы\n'
-        '/get_w - Информация о работающих в данной системе пользователях\n'
-        '/get_auths - Информация о последних 10 входах в систему\n'
-        '/get_critical - Информация о последних 5 критических событиях\n'
-        '/get_ps - Информация о запущенных процессах\n'
-        '/get_ss - Информация об используемых портах\n'
-        '/get_apt_list - Информация об установленных пакетах\n'
-        '/get_services - Информация о запущенных сервисах\n'
-        '/get_repl_logs - Вывод логов о репликации\n'
-        '/get_emails - Вывод Email адресов адресов почты из таблицы\n'
-        '/get_phone_numbers - Вывод телефонных номеров из таблицы'
+        fr'Привет {user.mention_markdown_v2()}\! Я готов помочь\. Вот доступные команды:' + '\n'
+        + escape_markdown(command_help(), version=2)
     )
-    logger.info(f"User {user.id} started the bot.")
+    logger.info("User %s started the bot.", user.id)
 
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /cancel для отмены текущей операции."""
     await update.message.reply_text('Операция отменена.', reply_markup=ReplyKeyboardRemove())
     return ConversationHandler.END
 
-# Функция для выполнения SSH-команд
-def execute_ssh_command(command):
+blocking_executor = ThreadPoolExecutor(max_workers=BLOCKING_WORKERS, thread_name_prefix='blocking')
+
+async def run_blocking(func, *args, **kwargs):
+    """Выполняет блокирующий вызов в ограниченном пуле потоков, не останавливая цикл событий."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(blocking_executor, functools.partial(func, *args, **kwargs))
+
+async def load_backend(name):
+    """Импортирует тяжелый модуль (paramiko, asyncpg) при первом обращении.
+
+    Импорт выполняется в пуле потоков: запуск бота и команды, не обращающиеся
+    к SSH и базе данных, не платят за загрузку этих библиотек.
+    """
+    module = sys.modules.get(name)
+    if module is None:
+        with metrics.timer('import'):
+            module = await run_blocking(importlib.import_module, name)
+        logger.info("Модуль %s загружен.", name)
+    return module
+
+# Метрики задержек и объемов
+# Границы корзин гистограмм: от 1 мс до ~110 с с шагом 2^(1/4) (погрешность квантилей ~19%)
+METRIC_BUCKETS = [0.001 * 2 ** (i / 4) for i in range(68)]
+# В формате Prometheus отдается каждая четвертая граница (степени двойки)
+PROMETHEUS_BUCKETS = METRIC_BUCKETS[::4]
+
+class Histogram:
+    """Гистограмма с фиксированными логарифмическими корзинами: O(log n) на наблюдение,
+    постоянный объем памяти."""
+
+    __slots__ = ('counts', 'count', 'sum')
+
+    def __init__(self):
+        self.counts = [0] * (len(METRIC_BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(METRIC_BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """Оценка квантиля линейной интерполяцией внутри корзины."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = METRIC_BUCKETS[i - 1] if i else 0.0
+                upper = METRIC_BUCKETS[i] if i < len(METRIC_BUCKETS) else lower
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return METRIC_BUCKETS[-1]
+
+    def cumulative(self, bounds):
+        """Накопленные счетчики для заданных границ (подмножества METRIC_BUCKETS)."""
+        result, seen, i = [], 0, 0
+        for bound in bounds:
+            while i < len(METRIC_BUCKETS) and METRIC_BUCKETS[i] <= bound:
+                seen += self.counts[i]
+                i += 1
+            result.append(seen)
+        return result
+
+
+def prometheus_labels(labels):
+    escaped = (
+        f'{key}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34)).replace(chr(10), " ")}"'
+        for key, value in labels.items()
+    )
+    return '{' + ','.join(escaped) + '}'
+
+
+class Metrics:
+    """Гистограммы длительности по (обработчик, фаза) и счетчики ошибок и байтов.
+
+    Фазы: total - обработка обновления целиком, ssh_connect, ssh_exec, db,
+    telegram - запросы к Bot API. Обработчик берется из current_handler.
+    """
+
+    def __init__(self):
+        self.histograms = {}
+        self.counters = Counter()
+        self.gauges = {}
+        self.started_at = time.time()
+
+    def observe(self, phase, seconds, handler=None):
+        key = (handler or current_handler.get(), phase)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        histogram.observe(seconds)
+
+    def count(self, name, value=1, handler=None):
+        self.counters[(name, handler or current_handler.get())] += value
+
+    @contextlib.contextmanager
+    def timer(self, phase):
+        """Замеряет длительность блока; исключение учитывается как ошибка фазы."""
+        started = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.count(f'{phase}_errors')
+            raise
+        finally:
+            self.observe(phase, time.perf_counter() - started)
+
+    def add_gauge(self, name, collect):
+        """Регистрирует функцию, возвращающую [(имя, метки, значение)] в момент снятия метрик."""
+        self.gauges[name] = collect
+
+    def gauge_values(self):
+        values = []
+        for name, collect in self.gauges.items():
+            try:
+                values.extend(collect())
+            except Exception as e:
+                logger.warning("Не удалось снять показатели %s: %s", name, e)
+        return values
+
+    def render_prometheus(self):
+        lines = ['# TYPE bot_phase_seconds histogram']
+        for (handler, phase), histogram in sorted(self.histograms.items()):
+            labels = {'handler': handler, 'phase': phase}
+            for bound, count in zip(PROMETHEUS_BUCKETS, histogram.cumulative(PROMETHEUS_BUCKETS)):
+                lines.append(f'bot_phase_seconds_bucket{prometheus_labels({**labels, "le": f"{bound:g}"})} {count}')
+            lines.append(f'bot_phase_seconds_bucket{prometheus_labels({**labels, "le": "+Inf"})} {histogram.count}')
+            lines.append(f'bot_phase_seconds_sum{prometheus_labels(labels)} {histogram.sum:.6f}')
+            lines.append(f'bot_phase_seconds_count{prometheus_labels(labels)} {histogram.count}')
+        names = sorted({name for name, _ in self.counters})
+        for name in names:
+            lines.append(f'# TYPE bot_{name}_total counter')
+            for (counter, handler), value in sorted(self.counters.items()):
+                if counter == name:
+                    lines.append(f'bot_{name}_total{prometheus_labels({"handler": handler})} {value}')
+        seen = set()
+        for name, labels, value in self.gauge_values():
+            if name not in seen:
+                seen.add(name)
+                lines.append(f'# TYPE bot_{name} gauge')
+            lines.append(f'bot_{name}{prometheus_labels(labels)} {value}')
+        lines.append('# TYPE bot_uptime_seconds gauge')
+        lines.append(f'bot_uptime_seconds {time.time() - self.started_at:.0f}')
+        return '\n'.join(lines) + '\n'
+
+    def render_text(self):
+        """Сводка для /bot_stats: квантили по обработчикам и фазам, счетчики и показатели."""
+        lines = [f"Время работы: {format_duration(time.time() - self.started_at)}", "",
+                 "Задержки, мс (p50 / p95 / p99, число):"]
+        ordered = sorted(self.histograms.items(), key=lambda item: (-item[1].count, item[0]))
+        for (handler, phase), histogram in ordered:
+            p50, p95, p99 = (histogram.quantile(q) * 1000 for q in (0.5, 0.95, 0.99))
+            lines.append(f"  {handler}/{phase}: {p50:.0f} / {p95:.0f} / {p99:.0f}, {histogram.count}")
+        if self.counters:
+            lines += ["", "Счетчики:"]
+            lines += [f"  {name} {handler}: {value}" for (name, handler), value in sorted(self.counters.items())]
+        gauges = self.gauge_values()
+        if gauges:
+            lines += ["", "Показатели:"]
+            for name, labels, value in gauges:
+                suffix = ' '.join(f"{key}={label}" for key, label in labels.items())
+                lines.append(f"  {name} {suffix}: {value}".replace(' :', ':'))
+        return "\n".join(lines)
+
+
+metrics = Metrics()
+
+
+class MeasuredRequest(BaseRequest):
+    """Обертка над запросами к Bot API: время отправки и объем переданных данных."""
+
+    def __init__(self, inner):
+        self.inner = inner
+
+    @property
+    def read_timeout(self):
+        return self.inner.read_timeout
+
+    async def initialize(self):
+        await self.inner.initialize()
+
+    async def shutdown(self):
+        await self.inner.shutdown()
+
+    async def do_request(self, url, method, request_data=None, read_timeout=BaseRequest.DEFAULT_NONE,
+                         write_timeout=BaseRequest.DEFAULT_NONE, connect_timeout=BaseRequest.DEFAULT_NONE,
+                         pool_timeout=BaseRequest.DEFAULT_NONE):
+        if request_data is not None:
+            sent = len(request_data.json_payload) if not request_data.contains_files else sum(
+                len(part[1]) for part in request_data.multipart_data.values()
+            )
+            metrics.count('telegram_bytes_sent', sent)
+        with metrics.timer('telegram'):
+            status, payload = await self.inner.do_request(
+                url, method, request_data, read_timeout, write_timeout, connect_timeout, pool_timeout
+            )
+        metrics.count('telegram_bytes_received', len(payload))
+        return status, payload
+
+
+def handler_commands(handlers):
+    """Все команды, зарегистрированные в обработчиках, включая вложенные в ConversationHandler."""
+    for handler in handlers:
+        if isinstance(handler, CommandHandler):
+            yield from handler.commands
+        elif isinstance(handler, ConversationHandler):
+            yield from handler_commands(handler.entry_points)
+            yield from handler_commands(handler.fallbacks)
+            for state_handlers in handler.states.values():
+                yield from handler_commands(state_handlers)
+
+
+class InstrumentedApplication(Application):
+    """Application, замеряющее обработку каждого обновления.
+
+    Имя обработчика для метрик определяется по обновлению: команда, функция
+    обработки кнопки, либо message/document для шагов диалогов. Неизвестные
+    команды объединяются под именем unknown, чтобы число меток было ограничено.
+    """
+
+    _commands = None
+
+    def update_label(self, update):
+        if not isinstance(update, Update):
+            return 'other'
+        if update.callback_query is not None:
+            for handler in self.handlers.get(0, []):
+                if isinstance(handler, CallbackQueryHandler) and handler.check_update(update):
+                    return handler.callback.__name__
+            return 'callback'
+        message = update.effective_message
+        if message is None:
+            return 'other'
+        if message.text and message.text.startswith('/'):
+            if self._commands is None:
+                self._commands = {
+                    command for group in self.handlers.values() for command in handler_commands(group)
+                }
+            command = message.text.split(maxsplit=1)[0][1:].split('@', 1)[0].lower()
+            return command if command in self._commands else 'unknown'
+        return 'document' if message.document else 'message'
+
+    async def process_update(self, update):
+        label = self.update_label(update)
+        user = update.effective_user if isinstance(update, Update) else None
+        handler_token = current_handler.set(label)
+        user_token = current_user.set(user.id if user else None)
+        started = time.perf_counter()
+        try:
+            await super().process_update(update)
+        finally:
+            duration = time.perf_counter() - started
+            metrics.observe('total', duration)
+            logger.info("Обновление %s обработано за %.1f мс", label, duration * 1000,
+                        extra={'duration_ms': round(duration * 1000, 1)})
+            current_user.reset(user_token)
+            current_handler.reset(handler_token)
+
+
+async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE):
+    """Учет и журналирование необработанных исключений обработчиков."""
+    metrics.count('errors')
+    logger.error("Ошибка при обработке обновления (%s): %s", current_handler.get(), context.error,
+                 exc_info=context.error)
+
+async def serve_metrics(reader, writer):
+    """Минимальный HTTP-ответчик: GET /metrics в текстовом формате Prometheus."""
     try:
+        request_line = await asyncio.wait_for(reader.readline(), 5)
+        # Заголовки запроса не нужны, но их нужно дочитать до пустой строки
+        while (await asyncio.wait_for(reader.readline(), 5)).strip():
+            pass
+        parts = request_line.decode('latin-1').split()
+        if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+            status, body = '200 OK', metrics.render_prometheus().encode('utf-8')
+        else:
+            status, body = '404 Not Found', b'not found\n'
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode('latin-1') + body
+        )
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+class SSHPool:
+    """Долгоживущее SSH-соединение с мультиплексированием каналов.
+
+    Ключевой обмен и аутентификация выполняются один раз, каждая команда
+    открывает отдельный канал поверх общего транспорта. Блокирующие вызовы
+    paramiko выполняются в пуле потоков, чтобы не останавливать цикл событий.
+    """
+
+    def __init__(self, host, port, username, password=None, key_filename=None,
+                 max_channels=SSH_MAX_CHANNELS):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.key_filename = key_filename
+        self.max_channels = max_channels
+        self._client = None
+        self._connect_lock = asyncio.Lock()
+        self._channels = asyncio.Semaphore(max_channels)
+        self.active_channels = 0
+
+    def _is_alive(self):
+        """Проверка работоспособности текущего транспорта."""
+        if self._client is None:
+            return False
+        transport = self._client.get_transport()
+        return transport is not None and transport.is_active() and transport.is_authenticated()
+
+    def _connect(self, paramiko):
         client = paramiko.SSHClient()
         client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        client.connect(RM_HOST, port=RM_PORT, username=RM_USER, password=RM_PASSWORD)
-        stdin, stdout, stderr = client.exec_command(command)
-        output = stdout.read().decode('utf-8').strip()
-        error = stderr.read().decode('utf-8').strip()
-        client.close()
-        if error:
-            return f"Ошибка при выполнении команды: {error}"
+        client.connect(
+            self.host,
+            port=self.port,
+            username=self.username,
+            password=self.password,
+            key_filename=self.key_filename,
+            timeout=SSH_CONNECT_TIMEOUT,
+            banner_timeout=SSH_CONNECT_TIMEOUT,
+            auth_timeout=SSH_CONNECT_TIMEOUT,
+        )
+        client.get_transport().set_keepalive(SSH_KEEPALIVE)
+        return client
+
+    def _close_client(self):
+        if self._client is not None:
+            self._client.close()
+            self._client = None
+
+    async def _ensure_client(self):
+        """Возвращает живое соединение, при необходимости переподключаясь с задержкой."""
+        if self._is_alive():
+            return self._client
+        paramiko = await load_backend('paramiko')
+        async with self._connect_lock:
+            if self._is_alive():
+                return self._client
+            self._close_client()
+            delay = SSH_RECONNECT_BACKOFF
+            for attempt in range(1, SSH_RECONNECT_ATTEMPTS + 1):
+                try:
+                    with metrics.timer('ssh_connect'):
+                        self._client = await run_blocking(self._connect, paramiko)
+                    logger.info("SSH-соединение с %s:%s установлено.", self.host, self.port)
+                    return self._client
+                except paramiko.AuthenticationException:
+                    raise
+                except Exception as e:
+                    if attempt == SSH_RECONNECT_ATTEMPTS:
+                        raise
+                    logger.warning("Попытка %s подключения к %s не удалась: %s", attempt, self.host, e)
+                    await asyncio.sleep(delay)
+                    delay *= 2
+
+    @staticmethod
+    def _exec(client, command):
+        channel = client.get_transport().open_session(timeout=SSH_CONNECT_TIMEOUT)
+        try:
+            channel.settimeout(SSH_COMMAND_TIMEOUT)
+            channel.exec_command(command)
+            stdout = channel.makefile('rb').read()
+            stderr = channel.makefile_stderr('rb').read()
+            status = channel.recv_exit_status()
+        finally:
+            channel.close()
+        return (
+            status,
+            stdout.decode('utf-8', errors='replace').strip(),
+            stderr.decode('utf-8', errors='replace').strip(),
+        )
+
+    async def run(self, command):
+        """Выполняет команду и возвращает (код возврата, stdout, stderr)."""
+        paramiko = await load_backend('paramiko')
+        async with self._channels:
+            for attempt in range(2):
+                client = await self._ensure_client()
+                self.active_channels += 1
+                try:
+                    with metrics.timer('ssh_exec'):
+                        status, output, error = await run_blocking(self._exec, client, command)
+                    metrics.count('ssh_bytes_received', len(output) + len(error))
+                    return status, output, error
+                except (paramiko.SSHException, EOFError, OSError):
+                    # Повторяем попытку только если упал сам транспорт
+                    if attempt or self._is_alive():
+                        raise
+                    logger.warning("SSH-транспорт к %s разорван, переподключение.", self.host)
+                    async with self._connect_lock:
+                        if self._client is client:
+                            self._close_client()
+                finally:
+                    self.active_channels -= 1
+
+    async def close(self):
+        async with self._connect_lock:
+            self._close_client()
+
+
+class CommandCache:
+    """LRU-кэш результатов с ограниченным временем жизни записей.
+
+    Одновременные запросы одного ключа объединяются: загрузка выполняется
+    один раз, и все ожидающие получают ее результат.
+    """
+
+    def __init__(self, max_entries, cacheable=None):
+        self.max_entries = max_entries
+        self.cacheable = cacheable
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    async def get(self, key, loader, ttl, refresh=False):
+        """Возвращает значение из кэша или загружает его вызовом loader()."""
+        if not refresh:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+        task = self._inflight.get(key)
+        if task is None:
+            self.misses += 1
+            task = asyncio.ensure_future(loader())
+            self._inflight[key] = task
+            task.add_done_callback(lambda done: self._store(key, ttl, done))
+        else:
+            self.coalesced += 1
+        # shield: отмена одного ожидающего не прерывает общую загрузку
+        return await asyncio.shield(task)
+
+    def _store(self, key, ttl, task):
+        self._inflight.pop(key, None)
+        if task.cancelled() or task.exception() is not None or ttl <= 0:
+            return
+        value = task.result()
+        if self.cacheable is not None and not self.cacheable(value):
+            return
+        self._entries[key] = (time.monotonic() + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, key=None):
+        if key is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(key, None)
+
+    def stats(self):
+        return {
+            'entries': len(self._entries),
+            'inflight': len(self._inflight),
+            'hits': self.hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+        }
+
+
+class HostInventory:
+    """Инвентарь хостов: SSH-пул на каждый хост и группы хостов.
+
+    Файл инвентаря (HOSTS_FILE) в формате JSON:
+        {"default": "db1",
+         "hosts": {"db1": {"host": "10.0.0.1", "port": 22, "user": "ops",
+                           "password": "...", "key_file": "~/.ssh/id_ed25519",
+                           "groups": ["db"]}}}
+    Без файла используется единственный хост из переменных RM_*.
+    """
+
+    def __init__(self, pools, groups, default):
+        self.pools = pools
+        self.groups = groups
+        self.default = default
+
+    @classmethod
+    def load(cls, path=HOSTS_FILE):
+        if not os.path.exists(path):
+            return cls({'default': SSHPool(RM_HOST, RM_PORT, RM_USER, RM_PASSWORD)}, {}, 'default')
+        with open(path, encoding='utf-8') as f:
+            data = json.load(f)
+        pools, groups = {}, {}
+        for name, spec in data['hosts'].items():
+            key_file = spec.get('key_file')
+            pools[name] = SSHPool(
+                spec['host'],
+                int(spec.get('port', 22)),
+                spec.get('user', RM_USER),
+                spec.get('password'),
+                os.path.expanduser(key_file) if key_file else None,
+                max_channels=int(spec.get('max_channels', SSH_MAX_CHANNELS)),
+            )
+            for group in spec.get('groups', []):
+                groups.setdefault(group, []).append(name)
+        return cls(pools, groups, data.get('default') or next(iter(pools)))
+
+    def resolve(self, selectors):
+        """Список хостов по селекторам @хост, @группа, @all (по умолчанию - основной хост)."""
+        if not selectors:
+            return [self.default]
+        hosts = []
+        for selector in selectors:
+            if selector == 'all':
+                names = list(self.pools)
+            elif selector in self.groups:
+                names = self.groups[selector]
+            elif selector in self.pools:
+                names = [selector]
+            else:
+                raise KeyError(selector)
+            hosts.extend(name for name in names if name not in hosts)
+        return hosts
+
+    async def close(self):
+        for pool in self.pools.values():
+            await pool.close()
+
+
+class RateLimiter:
+    """Корзины токенов по паре (пользователь, класс команд).
+
+    Корзина хранит только (токены, время обновления) и пополняется лениво при
+    обращении. Корзины упорядочены по времени последнего обращения, поэтому
+    простаивающие дольше времени полного пополнения (неотличимые от новых)
+    вытесняются с начала очереди за амортизированное O(1).
+    """
+
+    def __init__(self, limits, max_buckets=RATE_MAX_BUCKETS):
+        self.limits = limits
+        self.max_buckets = max_buckets
+        self.idle_ttl = max(burst / rate for burst, rate in limits.values())
+        self._buckets = OrderedDict()
+        self.rejected = 0
+
+    def acquire(self, user_id, command_class, cost=1):
+        """Списывает cost токенов; возвращает 0 или время в секундах до появления токенов."""
+        burst, rate = self.limits[command_class]
+        cost = min(cost, burst)
+        now = time.monotonic()
+        self._evict(now)
+        key = (user_id, command_class)
+        tokens, updated_at = self._buckets.pop(key, (burst, now))
+        tokens = min(burst, tokens + (now - updated_at) * rate)
+        wait = 0
+        if tokens >= cost:
+            tokens -= cost
+        else:
+            wait = (cost - tokens) / rate
+            self.rejected += 1
+        self._buckets[key] = (tokens, now)
+        return wait
+
+    def _evict(self, now):
+        while self._buckets:
+            key, (_, updated_at) = next(iter(self._buckets.items()))
+            if now - updated_at < self.idle_ttl and len(self._buckets) < self.max_buckets:
+                break
+            del self._buckets[key]
+
+    def stats(self):
+        return {'buckets': len(self._buckets), 'rejected': self.rejected}
+
+
+class AdmissionRejected(Exception):
+    """Операция не допущена: очередь ожидания заполнена или время ожидания истекло."""
+
+    def __init__(self, retry_after):
+        super().__init__(f"Бот занят, повторите через {retry_after} с.")
+        self.retry_after = retry_after
+
+
+class AdmissionControl:
+    """Ограничивает число одновременных тяжелых операций: SSH-команд, запросов
+    к базе данных и разбора больших документов.
+
+    Не более limit операций выполняются одновременно, не более queue_size
+    ждут своей очереди; остальные сразу получают отказ с оценкой времени,
+    через которое стоит повторить запрос. Слот занимается только на время
+    самой операции, а не всего обработчика.
+    """
+
+    def __init__(self, limit=ADMISSION_LIMIT, queue_size=ADMISSION_QUEUE, wait_timeout=ADMISSION_WAIT_TIMEOUT):
+        self.limit = limit
+        self.queue_size = queue_size
+        self.wait_timeout = wait_timeout
+        self._semaphore = asyncio.Semaphore(limit)
+        self.in_flight = 0
+        self.waiting = 0
+        self.rejected = 0
+        # Скользящее среднее длительности операции для оценки времени ожидания
+        self.avg_duration = 1.0
+
+    def retry_after(self):
+        return max(1, math.ceil(self.avg_duration * (self.waiting + 1) / self.limit))
+
+    @contextlib.asynccontextmanager
+    async def slot(self):
+        """Занимает слот на время блока или возбуждает AdmissionRejected."""
+        if self._semaphore.locked():
+            if self.waiting >= self.queue_size:
+                self.rejected += 1
+                raise AdmissionRejected(self.retry_after())
+            self.waiting += 1
+            try:
+                await asyncio.wait_for(self._semaphore.acquire(), self.wait_timeout)
+            except asyncio.TimeoutError:
+                self.rejected += 1
+                raise AdmissionRejected(self.retry_after()) from None
+            finally:
+                self.waiting -= 1
+        else:
+            await self._semaphore.acquire()
+        self.in_flight += 1
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            self.avg_duration += (time.monotonic() - started - self.avg_duration) * 0.1
+            self._semaphore.release()
+
+    async def run(self, func):
+        """Выполняет func() после получения слота или возбуждает AdmissionRejected."""
+        async with self.slot():
+            return await func()
+
+    def stats(self):
+        return {'in_flight': self.in_flight, 'waiting': self.waiting, 'rejected': self.rejected}
+
+
+inventory = HostInventory.load()
+# Кэшируются только успешные результаты (пустой stderr)
+command_cache = CommandCache(CACHE_MAX_ENTRIES, cacheable=lambda result: not result[2])
+
+rate_limiter = RateLimiter(RATE_LIMITS)
+admission = AdmissionControl()
+
+async def reply_busy(update: Update, text):
+    """Быстрый отказ: для нажатий кнопок - всплывающим уведомлением, иначе сообщением."""
+    if update.callback_query is not None:
+        await update.callback_query.answer(text, show_alert=True)
+    elif update.effective_message is not None:
+        await update.effective_message.reply_text(text)
+
+def limited(command_class):
+    """Декоратор обработчика: корзина токенов пользователя.
+
+    Стоимость берется из RATE_COSTS по имени обработчика. При отказе обработчик
+    не вызывается и возвращает None, поэтому диалог остается в текущем состоянии.
+    Общий допуск (admission) применяется ниже, к отдельным SSH- и DB-операциям;
+    не перехваченный обработчиком отказ допуска тоже отвечает пользователю.
+    """
+    def decorator(handler):
+        cost = RATE_COSTS.get(handler.__name__, 1)
+
+        @functools.wraps(handler)
+        async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+            user_id = update.effective_user.id if update.effective_user else None
+            wait = rate_limiter.acquire(user_id, command_class, cost)
+            if wait:
+                logger.info("User %s rate-limited in %s for %.1fs", user_id, handler.__name__, wait)
+                await reply_busy(update, f"Слишком много запросов, повторите через {math.ceil(wait)} с.")
+                return None
+            try:
+                return await handler(update, context)
+            except AdmissionRejected as e:
+                logger.warning("Admission rejected %s for user %s", handler.__name__, user_id)
+                await reply_busy(update, str(e))
+                return None
+        return wrapper
+    return decorator
+
+def wants_refresh(context):
+    """Проверяет, запросил ли пользователь обновление кэша аргументом refresh."""
+    return 'refresh' in (context.args or [])
+
+def split_targets(args):
+    """Отделяет селекторы хостов (@имя) от остальных аргументов команды."""
+    selectors, rest = [], []
+    for arg in args or []:
+        if arg.startswith('@') and len(arg) > 1:
+            selectors.append(arg[1:])
         else:
-            return output
+            rest.append(arg)
+    return selectors, rest
+
+async def run_remote(command, ttl=0, refresh=False, host=None):
+    """Выполняет команду через кэш и возвращает (код возврата, stdout, stderr)."""
+    host = host or inventory.default
+    pool = inventory.pools[host]
+    # Слот допуска занимает только выполнение команды: попадания в кэш и объединенные запросы его не ждут
+    return await command_cache.get(
+        (host, command), lambda: admission.run(lambda: pool.run(command)), ttl, refresh=refresh
+    )
+
+# Функция для выполнения SSH-команд
+async def execute_ssh_command(command, ttl=0, refresh=False, host=None):
+    try:
+        status, output, error = await run_remote(command, ttl, refresh, host)
+    except AdmissionRejected as e:
+        return str(e)
     except Exception as e:
         return f"Не удалось выполнить команду по SSH: {e}"
+    if error:
+        return f"Ошибка при выполнении команды: {error}"
+    else:
+        return output
+
+async def fan_out(hosts, func):
+    """Параллельно вызывает func(host) для каждого хоста и возвращает пары (хост, результат).
+
+    Число одновременных подключений ограничено FLEET_CONCURRENCY, время
+    ожидания каждого хоста - FLEET_HOST_TIMEOUT.
+    """
+    semaphore = asyncio.Semaphore(FLEET_CONCURRENCY)
+
+    async def run(host):
+        async with semaphore:
+            try:
+                result = await asyncio.wait_for(func(host), FLEET_HOST_TIMEOUT)
+            except asyncio.TimeoutError:
+                result = f"Превышено время ожидания ({FLEET_HOST_TIMEOUT:g} с)"
+            return host, result
+
+    return await asyncio.gather(*(run(host) for host in hosts))
+
+async def execute_on_hosts(hosts, command, ttl=0, refresh=False):
+    """Выполняет команду на нескольких хостах параллельно."""
+    return await fan_out(hosts, lambda host: execute_ssh_command(command, ttl, refresh, host))
+
+def format_fleet_report(results, empty_text="(пусто)"):
+    """Сводный отчет: хосты с одинаковым выводом объединяются под одним заголовком."""
+    grouped = OrderedDict()
+    for host, output in results:
+        grouped.setdefault(output, []).append(host)
+    return "\n\n".join(
+        f"=== {', '.join(hosts)} ===\n{output or empty_text}" for output, hosts in grouped.items()
+    )
+
+# Единый слой доставки ответов
+@dataclass(slots=True)
+class PagedOutput:
+    chat_id: int
+    text: str
+    pages: list
+    filename: str
+
+
+def split_pages(text, size=REPLY_PAGE_SIZE):
+    """Границы страниц (начало, конец) по границам строк; слишком длинные строки режутся."""
+    pages = []
+    start = 0
+    while start < len(text):
+        end = start + size
+        if end < len(text):
+            newline = text.rfind('\n', start, end)
+            if newline > start:
+                end = newline + 1
+        pages.append((start, min(end, len(text))))
+        start = end
+    return pages
+
+
+class OutputCache:
+    """LRU-кэш недавних длинных выводов для листания страниц без повторного выполнения команды.
+
+    Ограничен числом записей и суммарным объемом текста.
+    """
+
+    def __init__(self, max_entries=OUTPUT_CACHE_ENTRIES, max_chars=OUTPUT_CACHE_CHARS):
+        self.max_entries = max_entries
+        self.max_chars = max_chars
+        self._entries = OrderedDict()
+        self._chars = 0
+
+    def put(self, entry):
+        token = secrets.token_urlsafe(6)
+        self._entries[token] = entry
+        self._chars += len(entry.text)
+        while len(self._entries) > self.max_entries or (self._chars > self.max_chars and len(self._entries) > 1):
+            _, evicted = self._entries.popitem(last=False)
+            self._chars -= len(evicted.text)
+        return token
+
+    def get(self, token):
+        entry = self._entries.get(token)
+        if entry is not None:
+            self._entries.move_to_end(token)
+        return entry
+
+    def stats(self):
+        return {'entries': len(self._entries), 'chars': self._chars}
+
+
+output_cache = OutputCache()
+
+def output_keyboard(token, page, pages):
+    """Навигация по страницам вывода и выгрузка его целиком."""
+    row = []
+    if page > 0:
+        row.append(InlineKeyboardButton('◀', callback_data=f'page:{token}:{page - 1}'))
+    row.append(InlineKeyboardButton(f'{page + 1}/{pages}', callback_data=f'page:{token}:-'))
+    if page + 1 < pages:
+        row.append(InlineKeyboardButton('▶', callback_data=f'page:{token}:{page + 1}'))
+    return InlineKeyboardMarkup([row, [InlineKeyboardButton('Скачать файлом', callback_data=f'page:{token}:file')]])
+
+async def compressed_document(text, filename):
+    """Сжатый документ в памяти; сжатие выполняется в пуле потоков."""
+    document = io.BytesIO(await run_blocking(gzip.compress, text.encode('utf-8')))
+    document.name = filename + '.gz'
+    caption = f"Вывод целиком: {len(text)} символов, сжатие gzip"
+    return document, caption
+
+async def prepare_output(text, chat_id, filename):
+    """Выбирает способ доставки: ('text', текст, клавиатура) или ('document', файл, подпись)."""
+    if len(text) <= 4096:
+        return 'text', text, None
+    if len(text) > REPLY_DOCUMENT_THRESHOLD:
+        return ('document', *await compressed_document(text, filename))
+    pages = split_pages(text)
+    token = output_cache.put(PagedOutput(chat_id, text, pages, filename))
+    start, end = pages[0]
+    return 'text', text[start:end], output_keyboard(token, 0, len(pages))
+
+async def reply_output(message, text, filename='output.txt'):
+    """Отвечает на сообщение текстом, страницами с навигацией или сжатым документом."""
+    kind, payload, extra = await prepare_output(text, message.chat_id, filename)
+    if kind == 'text':
+        await message.reply_text(payload, reply_markup=extra)
+    else:
+        await message.reply_document(document=payload, caption=extra)
+
+async def send_output(bot, chat_id, text, filename='output.txt'):
+    """То же, что reply_output, для отправки из фоновых задач."""
+    kind, payload, extra = await prepare_output(text, chat_id, filename)
+    if kind == 'text':
+        await bot.send_message(chat_id, payload, reply_markup=extra)
+    else:
+        await bot.send_document(chat_id, document=payload, caption=extra)
+
+async def output_page_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Листание страниц длинного вывода из кэша и выгрузка его файлом."""
+    query = update.callback_query
+    _, token, action = query.data.split(':')
+    entry = output_cache.get(token)
+    if entry is None or entry.chat_id != query.message.chat_id:
+        await query.answer("Вывод устарел, повторите команду.", show_alert=True)
+        return
+    if action == '-':
+        await query.answer()
+    elif action == 'file':
+        await query.answer("Подготовка файла...")
+        document, caption = await compressed_document(entry.text, entry.filename)
+        await query.message.reply_document(document=document, caption=caption)
+    else:
+        page = min(max(int(action), 0), len(entry.pages) - 1)
+        start, end = entry.pages[page]
+        await query.answer()
+        await query.edit_message_text(entry.text[start:end], reply_markup=output_keyboard(token, page, len(entry.pages)))
+
+async def reply_remote_command(update: Update, context: ContextTypes.DEFAULT_TYPE, command, ttl=0,
+                               selectors=None, empty_text="(пусто)", filename='output.txt'):
+    """Выполняет команду на выбранных хостах и отправляет результат пользователю."""
+    if selectors is None:
+        selectors, _ = split_targets(context.args)
+    hosts = await resolve_targets(update, selectors)
+    if hosts is None:
+        return
+    refresh = wants_refresh(context)
+    if len(hosts) == 1:
+        response = await execute_ssh_command(command, ttl, refresh, hosts[0]) or empty_text
+    else:
+        response = format_fleet_report(await execute_on_hosts(hosts, command, ttl, refresh), empty_text)
+    await reply_output(update.message, response, filename)
+
+async def resolve_targets(update: Update, selectors):
+    """Список хостов по селекторам; при ошибке пользователь получает ответ и возвращается None."""
+    try:
+        return inventory.resolve(selectors)
+    except KeyError as e:
+        await update.message.reply_text(f"Неизвестный хост или группа: {e.args[0]}")
+        return None
+
+# Разбор вывода команд в компактные записи
+@dataclass(slots=True)
+class DiskUsage:
+    filesystem: str
+    size: int
+    used: int
+    avail: int
+    use_percent: int
+    mount: str
+
+@dataclass(slots=True)
+class MemoryUsage:
+    kind: str
+    total: int
+    used: int
+    free: int
+    available: int
+
+@dataclass(slots=True)
+class ProcessInfo:
+    user: str
+    pid: int
+    cpu: float
+    mem: float
+    rss: int
+    stat: str
+    command: str
+
+@dataclass(slots=True)
+class SocketInfo:
+    netid: str
+    state: str
+    local_address: str
+    local_port: str
+    peer: str
+
+@dataclass(slots=True)
+class CpuUsage:
+    cpu: str
+    usr: float
+    sys: float
+    iowait: float
+    idle: float
+
+    @property
+    def busy(self):
+        return 100.0 - self.idle
+
+@dataclass(slots=True)
+class ServiceInfo:
+    unit: str
+    active: str
+    sub: str
+    description: str
+
+def format_size(kb):
+    for unit in ('КБ', 'МБ', 'ГБ'):
+        if kb < 1024:
+            return f"{kb:.1f} {unit}"
+        kb /= 1024
+    return f"{kb:.1f} ТБ"
+
+def parse_df(output):
+    """Вывод df -Pk: размеры в килобайтах."""
+    records = []
+    for line in output.splitlines()[1:]:
+        fs, size, used, avail, capacity, mount = line.split(None, 5)
+        records.append(DiskUsage(fs, int(size), int(used), int(avail), int(capacity.rstrip('%')), mount))
+    return records
+
+def parse_free(output):
+    """Вывод free -k."""
+    records = []
+    for line in output.splitlines()[1:]:
+        kind, *values = line.split()
+        values = [int(v) for v in values]
+        available = values[5] if len(values) > 5 else values[2]
+        records.append(MemoryUsage(kind.rstrip(':'), values[0], values[1], values[2], available))
+    return records
+
+def parse_ps(output):
+    """Вывод ps aux."""
+    records = []
+    for line in output.splitlines()[1:]:
+        user, pid, cpu, mem, _, rss, _, stat, _, _, command = line.split(None, 10)
+        records.append(ProcessInfo(user, int(pid), float(cpu), float(mem), int(rss), stat, command))
+    return records
+
+def parse_ss(output):
+    """Вывод ss -tuln."""
+    records = []
+    for line in output.splitlines()[1:]:
+        netid, state, _, _, local, peer = line.split(None, 6)[:6]
+        address, _, port = local.rpartition(':')
+        records.append(SocketInfo(netid, state, address, port, peer))
+    return records
+
+def parse_mpstat(output):
+    """Строки Average из вывода mpstat -P ALL."""
+    records, columns = [], None
+    for line in output.splitlines():
+        if not line.startswith('Average:'):
+            continue
+        fields = line.split()[1:]
+        if fields[0] == 'CPU':
+            columns = {name: i for i, name in enumerate(fields)}
+        elif columns:
+            records.append(CpuUsage(
+                fields[0],
+                float(fields[columns['%usr']]),
+                float(fields[columns['%sys']]),
+                float(fields[columns['%iowait']]),
+                float(fields[columns['%idle']]),
+            ))
+    return records
+
+def parse_services(output):
+    """Вывод systemctl list-units --no-legend --plain."""
+    records = []
+    for line in output.splitlines():
+        unit, _, active, sub, *description = line.split(None, 4)
+        records.append(ServiceInfo(unit, active, sub, description[0] if description else ''))
+    return records
+
+@dataclass
+class CommandView:
+    """Описание команды со структурированным выводом: разбор, сортировки, фильтры и отрисовка.
+
+    sampled и trends задаются для команд, на которые можно ответить по последнему
+    замеру фонового опроса: записи из замера и ключи рядов истории для трендов.
+    """
+    command: str
+    ttl: int
+    parse: object
+    render: object
+    header: str
+    sorts: dict = field(default_factory=dict)
+    filters: dict = field(default_factory=dict)
+    default_sort: str = None
+    default_limit: int = None
+    sampled: object = None
+    trends: object = None
+
+def parse_view_args(view, args):
+    """Разбирает аргументы вида [сортировка] [N] [фильтр значение] ..."""
+    sort, limit, selected = view.default_sort, view.default_limit, {}
+    tokens = iter(args)
+    for token in tokens:
+        if token.isdigit():
+            limit = int(token)
+        elif token in view.sorts:
+            sort = token
+        elif token in view.filters:
+            value = next(tokens, None)
+            if value is None:
+                raise ValueError(f"не указано значение фильтра {token}")
+            selected[token] = value
+        elif token != 'refresh':
+            raise ValueError(f"неизвестный аргумент {token}")
+    return sort, limit, selected
+
+def apply_view(view, records, sort, limit, selected):
+    """Фильтрует, сортирует и отрисовывает только запрошенную часть записей."""
+    for name, value in selected.items():
+        predicate = view.filters[name]
+        records = [record for record in records if predicate(record, value)]
+    total = len(records)
+    if sort:
+        key, reverse = view.sorts[sort]
+        if limit:
+            records = (heapq.nlargest if reverse else heapq.nsmallest)(limit, records, key)
+        else:
+            records = sorted(records, key=key, reverse=reverse)
+    records = records[:limit] if limit else records
+    lines = [view.header] + [view.render(record) for record in records]
+    if len(records) < total:
+        lines.append(f"... показано {len(records)} из {total}")
+    return "\n".join(lines)
+
+def view_usage(name, view):
+    parts = [f"/{name}"]
+    if view.sorts:
+        parts.append("[" + "|".join(view.sorts) + "]")
+    parts.append("[N]")
+    parts.extend(f"[{flt} значение]" for flt in view.filters)
+    return " ".join(parts) + " [@хост]"
+
+DF_VIEW = CommandView(
+    command='LC_ALL=C df -Pk',
+    ttl=CACHE_TTL_SHORT,
+    parse=parse_df,
+    render=lambda r: f"{r.use_percent:>3}% {format_size(r.used):>10} / {format_size(r.size):<10} {r.mount}",
+    header="Исп. Занято / Всего      Точка монтирования",
+    sorts={'use': (lambda r: r.use_percent, True), 'size': (lambda r: r.size, True), 'avail': (lambda r: r.avail, False)},
+    filters={'mount': lambda r, v: v in r.mount, 'fs': lambda r, v: v in r.filesystem},
+    sampled=lambda sample: sample.disks,
+    trends=lambda records: [f'disk:{r.mount}' for r in records],
+)
+FREE_VIEW = CommandView(
+    command='LC_ALL=C free -k',
+    ttl=CACHE_TTL_SHORT,
+    parse=parse_free,
+    render=lambda r: f"{r.kind:<5} {format_size(r.total):>10} {format_size(r.used):>10} "
+                     f"{format_size(r.free):>10} {format_size(r.available):>10}",
+    header="Тип        Всего     Занято   Свободно   Доступно",
+    sampled=lambda sample: sample.memory,
+    trends=lambda records: ['mem', 'swap'],
+)
+PS_VIEW = CommandView(
+    command='LC_ALL=C ps aux',
+    ttl=CACHE_TTL_SHORT,
+    parse=parse_ps,
+    render=lambda r: f"{r.pid:>7} {r.user[:10]:<10} {r.cpu:5.1f} {r.mem:5.1f} {r.command[:60]}",
+    header="    PID USER        %CPU  %MEM COMMAND",
+    sorts={'cpu': (lambda r: r.cpu, True), 'mem': (lambda r: r.mem, True), 'rss': (lambda r: r.rss, True)},
+    filters={'user': lambda r, v: r.user == v, 'name': lambda r, v: v in r.command},
+    default_sort='mem',
+    default_limit=10,
+)
+SS_VIEW = CommandView(
+    command='LC_ALL=C ss -tuln',
+    ttl=CACHE_TTL_SHORT,
+    parse=parse_ss,
+    render=lambda r: f"{r.netid:<4} {r.state:<7} {r.local_address}:{r.local_port}",
+    header="Тип  Состояние Адрес",
+    filters={
+        'port': lambda r, v: r.local_port == v,
+        'proto': lambda r, v: r.netid == v,
+        'state': lambda r, v: r.state.lower() == v.lower(),
+    },
+)
+MPSTAT_VIEW = CommandView(
+    command='LC_ALL=C mpstat -P ALL 1 1',
+    ttl=CACHE_TTL_SHORT,
+    parse=parse_mpstat,
+    render=lambda r: f"{r.cpu:>4} {r.usr:6.1f} {r.sys:6.1f} {r.iowait:7.1f} {r.busy:6.1f}",
+    header=" CPU   %usr   %sys %iowait  %busy",
+    sorts={'busy': (lambda r: r.busy, True), 'iowait': (lambda r: r.iowait, True)},
+)
+SERVICES_VIEW = CommandView(
+    command='LC_ALL=C systemctl list-units --type=service --state=running --no-legend --plain --no-pager',
+    ttl=CACHE_TTL_MEDIUM,
+    parse=parse_services,
+    render=lambda r: f"{r.unit} - {r.description}",
+    header="Запущенные сервисы:",
+    filters={'name': lambda r, v: v in r.unit},
+)
+
+async def render_view(view, host, sort, limit, selected, refresh):
+    """Выполняет команду на хосте и возвращает отрисованную часть результата.
+
+    Если фоновый опрос недавно снимал эти данные, команда не выполняется:
+    ответ строится по последнему замеру и дополняется трендами.
+    """
+    sample = monitor.fresh_sample(host) if view.sampled is not None and not refresh else None
+    if sample is not None:
+        records = view.sampled(sample)
+        lines = [apply_view(view, records, sort, limit, selected), "",
+                 f"Замер {time.strftime('%H:%M:%S', time.localtime(sample.time))}, тренд:"]
+        lines += monitor.trend_lines(host, view.trends(records))
+        return "\n".join(lines)
+    try:
+        _, output, error = await run_remote(view.command, view.ttl, refresh, host)
+    except AdmissionRejected as e:
+        return str(e)
+    except Exception as e:
+        return f"Не удалось выполнить команду по SSH: {e}"
+    if error and not output:
+        return f"Ошибка при выполнении команды: {error}"
+    try:
+        records = view.parse(output)
+    except (ValueError, IndexError, KeyError) as e:
+        logger.warning("Не удалось разобрать вывод '%s' с %s: %s", view.command, host, e)
+        return output
+    if not records and len(output.splitlines()) > 1:
+        # Формат не распознан (например, локализованный вывод) - показываем как есть
+        logger.warning("В выводе '%s' с %s не найдено записей", view.command, host)
+        return output
+    return apply_view(view, records, sort, limit, selected)
+
+async def reply_view(update: Update, context: ContextTypes.DEFAULT_TYPE, name, view):
+    """Обработчик команды со структурированным выводом."""
+    selectors, args = split_targets(context.args)
+    try:
+        sort, limit, selected = parse_view_args(view, args)
+    except ValueError as e:
+        await update.message.reply_text(f"Ошибка в аргументах: {e}\nИспользование: {view_usage(name, view)}")
+        return
+    hosts = await resolve_targets(update, selectors)
+    if hosts is None:
+        return
+    refresh = wants_refresh(context)
+    results = await fan_out(hosts, lambda host: render_view(view, host, sort, limit, selected, refresh))
+    if len(results) == 1:
+        response = results[0][1]
+    else:
+        response = format_fleet_report(results)
+    await reply_output(update.message, response, f'{name}.txt')
 
 # Информация о релизе системы
+@limited('ssh')
 async def get_release(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    logger.info(f"User {update.effective_user.id} requested /get_release")
-    response = execute_ssh_command('cat /etc/os-release')
-    await update.message.reply_text(response)
+    logger.info("User %s requested /get_release", update.effective_user.id)
+    await reply_remote_command(update, context, 'cat /etc/os-release', ttl=CACHE_TTL_LONG)
 
 # Информация об архитектуре процессора, имени хоста и версии ядра
+@limited('ssh')
 async def get_uname(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    logger.info(f"User {update.effective_user.id} requested /get_uname")
-    response = execute_ssh_command('uname -a')
-    await update.message.reply_text(response)
+    logger.info("User %s requested /get_uname", update.effective_user.id)
+    await reply_remote_command(update, context, 'uname -a', ttl=CACHE_TTL_LONG)
 
 # Информация о времени работы системы
+@limited('ssh')
 async def get_uptime(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    logger.info(f"User {update.effective_user.id} requested /get_uptime")
-    response = execute_ssh_command('uptime -p')
-    await update.message.reply_text(response)
+    logger.info("User %s requested /get_uptime", update.effective_user.id)
+    await reply_remote_command(update, context, 'uptime -p', ttl=CACHE_TTL_SHORT)
 
 # Состояние файловой системы
+@limited('ssh')
 async def get_df(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    logger.info(f"User {update.effective_user.id} requested /get_df")
-    response = execute_ssh_command('df -h')
-    await update.message.reply_text(response)
+    logger.info("User %s requested /get_df", update.effective_user.id)
+    await reply_view(update, context, 'get_df', DF_VIEW)
 
 # Состояние оперативной памяти
+@limited('ssh')
 async def get_free(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    logger.info(f"User {update.effective_user.id} requested /get_free")
-    response = execute_ssh_command('free -h')
-    await update.message.reply_text(response)
+    logger.info("User %s requested /get_free", update.effective_user.id)
+    await reply_view(update, context, 'get_free', FREE_VIEW)
 
 # Производительность системы
+@limited('ssh')
 async def get_mpstat(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    logger.info(f"User {update.effective_user.id} requested /get_mpstat")
-    response = execute_ssh_command('mpstat -P ALL 1 1')
-    await update.message.reply_text(response)
+    logger.info("User %s requested /get_mpstat", update.effective_user.id)
+    await reply_view(update, context, 'get_mpstat', MPSTAT_VIEW)
 
 # Информация о пользователях в системе
+@limited('ssh')
 async def get_w(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    logger.info(f"User {update.effective_user.id} requested /get_w")
-    response = execute_ssh_command('w')
-    await update.message.reply_text(response)
+    logger.info("User %s requested /get_w", update.effective_user.id)
+    await reply_remote_command(update, context, 'w', ttl=CACHE_TTL_SHORT)
 
 # Последние 10 входов в систему
+@limited('ssh')
 async def get_auths(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    logger.info(f"User {update.effective_user.id} requested /get_auths")
-    response = execute_ssh_command('last -n 10')
-    await update.message.reply_text(response)
+    logger.info("User %s requested /get_auths", update.effective_user.id)
+    await reply_remote_command(update, context, 'last -n 10', ttl=CACHE_TTL_MEDIUM)
 
 # Последние 5 критических событий
+@limited('ssh')
 async def get_critical(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    logger.info(f"User {update.effective_user.id} requested /get_critical")
-    response = execute_ssh_command('journalctl -p crit -n 5')
-    await update.message.reply_text(response)
+    logger.info("User %s requested /get_critical", update.effective_user.id)
+    await reply_remote_command(update, context, 'journalctl -p crit -n 5', ttl=CACHE_TTL_MEDIUM)
 
 # Список запущенных процессов
+@limited('ssh')
 async def get_ps(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    logger.info(f"User {update.effective_user.id} requested /get_ps")
-    response = execute_ssh_command('ps aux --sort=-%mem | head -n 10')
-    await update.message.reply_text(response)
+    logger.info("User %s requested /get_ps", update.effective_user.id)
+    await reply_view(update, context, 'get_ps', PS_VIEW)
 
 # Используемые порты
+@limited('ssh')
 async def get_ss(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    logger.info(f"User {update.effective_user.id} requested /get_ss")
-    response = execute_ssh_command('ss -tuln')
-    await update.message.reply_text(response)
+    logger.info("User %s requested /get_ss", update.effective_user.id)
+    await reply_view(update, context, 'get_ss', SS_VIEW)
 
 # Сбор информации о запущенных сервисах
+@limited('ssh')
 async def get_services(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    logger.info(f"User {update.effective_user.id} requested /get_services")
-    response = execute_ssh_command('systemctl list-units --type=service --state=running')
-    await update.message.reply_text(response)
+    logger.info("User %s requested /get_services", update.effective_user.id)
+    await reply_view(update, context, 'get_services', SERVICES_VIEW)
+
+# Сводка состояния системы одним запросом: все данные собираются одним скриптом
+HEALTH_SCRIPT = (
+    "export LC_ALL=C; "
+    "echo @@stat1; head -n 1 /proc/stat; "
+    "echo @@uptime; cat /proc/uptime; "
+    "echo @@loadavg; cat /proc/loadavg; "
+    "echo @@nproc; nproc; "
+    "echo @@meminfo; grep -E '^(MemTotal|MemAvailable|SwapTotal|SwapFree):' /proc/meminfo; "
+    "echo @@df; df -Pk -x tmpfs -x devtmpfs -x squashfs -x overlay; "
+    "echo @@ps; ps -eo pid,pcpu,pmem,comm --sort=-pcpu | head -n 6; "
+    "echo @@ss; ss -H -tuln | wc -l; ss -H -tn state established | wc -l; "
+    f"sleep {HEALTH_CPU_SAMPLE:g}; echo @@stat2; head -n 1 /proc/stat"
+)
+
+@dataclass
+class HealthSnapshot:
+    uptime: float
+    load: tuple
+    cpus: int
+    cpu_percent: float
+    mem_total: int
+    mem_available: int
+    swap_total: int
+    swap_free: int
+    disks: list = field(default_factory=list)
+    processes: list = field(default_factory=list)
+    listening: int = 0
+    established: int = 0
+
+    @property
+    def mem_percent(self):
+        return 100.0 * (self.mem_total - self.mem_available) / self.mem_total if self.mem_total else 0.0
+
+    @property
+    def swap_percent(self):
+        return 100.0 * (self.swap_total - self.swap_free) / self.swap_total if self.swap_total else 0.0
+
+def split_sections(output):
+    """Разбивает вывод составного скрипта на секции по маркерам @@имя."""
+    sections, current = {}, None
+    for line in output.splitlines():
+        if line.startswith('@@'):
+            current = sections.setdefault(line[2:].strip(), [])
+        elif current is not None and line.strip():
+            current.append(line)
+    return sections
+
+def cpu_busy_percent(first, second):
+    """Загрузка CPU между двумя строками 'cpu ...' из /proc/stat."""
+    a = [int(v) for v in first.split()[1:]]
+    b = [int(v) for v in second.split()[1:]]
+    total = sum(b) - sum(a)
+    idle = (b[3] + b[4]) - (a[3] + a[4])
+    return 100.0 * (total - idle) / total if total > 0 else 0.0
+
+def parse_health(output):
+    sections = split_sections(output)
+    meminfo = {}
+    for line in sections.get('meminfo', []):
+        key, value = line.split(':', 1)
+        meminfo[key] = int(value.split()[0])
+    processes = []
+    for line in sections.get('ps', [])[1:]:
+        pid, cpu, mem, command = line.split(None, 3)
+        processes.append((int(pid), float(cpu), float(mem), command))
+    sockets = sections.get('ss', ['0', '0'])
+    return HealthSnapshot(
+        uptime=float(sections['uptime'][0].split()[0]),
+        load=tuple(float(v) for v in sections['loadavg'][0].split()[:3]),
+        cpus=int(sections['nproc'][0]),
+        cpu_percent=cpu_busy_percent(sections['stat1'][0], sections['stat2'][0]),
+        mem_total=meminfo.get('MemTotal', 0),
+        mem_available=meminfo.get('MemAvailable', 0),
+        swap_total=meminfo.get('SwapTotal', 0),
+        swap_free=meminfo.get('SwapFree', 0),
+        disks=parse_df("\n".join(sections.get('df', []))),
+        processes=processes,
+        listening=int(sockets[0]),
+        established=int(sockets[1]),
+    )
+
+def format_duration(seconds):
+    days, seconds = divmod(int(seconds), 86400)
+    hours, seconds = divmod(seconds, 3600)
+    return f"{days} д {hours} ч {seconds // 60} мин" if days else f"{hours} ч {seconds // 60} мин"
+
+def health_mark(metric, value):
+    """Отметка уровня по порогам HEALTH_THRESHOLDS: норма, предупреждение, авария."""
+    warn, crit = HEALTH_THRESHOLDS[metric]
+    return '🔴' if value >= crit else '🟡' if value >= warn else '🟢'
+
+def render_health(host, snapshot):
+    load_per_cpu = snapshot.load[0] / max(snapshot.cpus, 1)
+    lines = [
+        f"🖥 {host}: работает {format_duration(snapshot.uptime)}",
+        f"{health_mark('cpu', snapshot.cpu_percent)} CPU: {snapshot.cpu_percent:.1f}% (ядер: {snapshot.cpus})",
+        f"{health_mark('load', load_per_cpu)} Load: " + " ".join(f"{v:.2f}" for v in snapshot.load),
+        f"{health_mark('mem', snapshot.mem_percent)} Память: {snapshot.mem_percent:.1f}% "
+        f"из {format_size(snapshot.mem_total)}",
+    ]
+    if snapshot.swap_total:
+        lines.append(f"{health_mark('swap', snapshot.swap_percent)} Swap: {snapshot.swap_percent:.1f}% "
+                     f"из {format_size(snapshot.swap_total)}")
+    lines.append("Диски:")
+    for disk in snapshot.disks:
+        lines.append(f"  {health_mark('disk', disk.use_percent)} {disk.mount} {disk.use_percent}% "
+                     f"(свободно {format_size(disk.avail)} из {format_size(disk.size)})")
+    lines.append(f"Сеть: {snapshot.listening} прослушиваемых портов, {snapshot.established} соединений")
+    if snapshot.processes:
+        lines.append("Топ процессов по CPU:")
+        for pid, cpu, mem, command in snapshot.processes:
+            lines.append(f"  {pid} {command} CPU {cpu:.1f}% MEM {mem:.1f}%")
+    return "\n".join(lines)
+
+async def collect_health(host, refresh=False):
+    """Снимает и форматирует сводку состояния одного хоста."""
+    try:
+        _, output, error = await run_remote(HEALTH_SCRIPT, CACHE_TTL_SHORT, refresh, host)
+        return render_health(host, parse_health(output))
+    except Exception as e:
+        logger.warning("Не удалось получить сводку состояния %s: %s", host, e)
+        return f"🖥 {host}: не удалось получить сводку состояния: {e}"
+
+# Сводка состояния системы
+@limited('ssh')
+async def get_health(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    logger.info("User %s requested /get_health", update.effective_user.id)
+    selectors, _ = split_targets(context.args)
+    hosts = await resolve_targets(update, selectors)
+    if hosts is None:
+        return
+    refresh = wants_refresh(context)
+    results = await fan_out(hosts, lambda host: collect_health(host, refresh))
+    await reply_output(update.message, "\n\n".join(text for _, text in results), 'health.txt')
+
+# Фоновый опрос хостов и оповещения
+MONITOR_SCRIPT = (
+    "export LC_ALL=C; "
+    "echo @@stat; head -n 1 /proc/stat; "
+    "echo @@loadavg; cat /proc/loadavg; "
+    "echo @@nproc; nproc; "
+    "echo @@free; free -k; "
+    "echo @@df; df -Pk"
+)
+# Файловые системы в памяти и образы не отслеживаются
+PSEUDO_FILESYSTEMS = ('tmpfs', 'devtmpfs', 'udev', 'overlay', 'none', 'shm')
+SPARKLINE = '▁▂▃▄▅▆▇█'
+ALERT_MARKS = {0: '🟢', 1: '🟡', 2: '🔴'}
+
+
+@dataclass(slots=True)
+class MonitorSample:
+    time: float
+    stat: str
+    load: tuple
+    cpus: int
+    memory: list
+    disks: list
+
+
+def parse_monitor_sample(output, timestamp):
+    sections = split_sections(output)
+    return MonitorSample(
+        time=timestamp,
+        stat=sections['stat'][0],
+        load=tuple(float(v) for v in sections['loadavg'][0].split()[:3]),
+        cpus=int(sections['nproc'][0]),
+        memory=parse_free("\n".join(sections.get('free', []))),
+        disks=parse_df("\n".join(sections.get('df', []))),
+    )
+
+
+class HostHistory:
+    """Кольцевые буферы истории одного хоста: общий буфер времени и по массиву
+    float32 на каждый ряд (cpu, load, mem, swap, disk:<точка монтирования>)."""
+
+    __slots__ = ('size', 'times', 'series', 'next', 'count', 'prev_stat')
+
+    def __init__(self, size=MONITOR_HISTORY):
+        self.size = size
+        self.times = array.array('d', [0.0]) * size
+        self.series = {}
+        self.next = 0
+        self.count = 0
+        self.prev_stat = None
+
+    def append(self, timestamp, values):
+        index = self.next
+        self.times[index] = timestamp
+        for key, value in values.items():
+            buffer = self.series.get(key)
+            if buffer is None:
+                buffer = self.series[key] = array.array('f', [math.nan]) * self.size
+            buffer[index] = value
+        for key in [key for key in self.series if key not in values]:
+            self.series[key][index] = math.nan
+            # Ряд исчезнувшего диска удаляется, когда в нем не осталось значений
+            if all(math.isnan(value) for value in self.series[key]):
+                del self.series[key]
+        self.next = (index + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+
+    def points(self, key, since=None):
+        """Значения ряда в хронологическом порядке: [(время, значение)]."""
+        buffer = self.series.get(key)
+        if buffer is None:
+            return []
+        start = (self.next - self.count) % self.size
+        result = []
+        for offset in range(self.count):
+            index = (start + offset) % self.size
+            value = buffer[index]
+            if not math.isnan(value) and (since is None or self.times[index] >= since):
+                result.append((self.times[index], value))
+        return result
+
+
+def sparkline(values):
+    if not values:
+        return ''
+    low, high = min(values), max(values)
+    scale = (len(SPARKLINE) - 1) / (high - low) if high > low else 0
+    return ''.join(SPARKLINE[round((value - low) * scale)] for value in values)
+
+def sample_values(history, sample):
+    """Значения рядов по замеру; загрузка CPU считается по разнице с предыдущим замером."""
+    values = {'load': sample.load[0] / max(sample.cpus, 1)}
+    if history.prev_stat is not None:
+        values['cpu'] = cpu_busy_percent(history.prev_stat, sample.stat)
+    history.prev_stat = sample.stat
+    for record in sample.memory:
+        if record.kind in ('Mem', 'Swap') and record.total:
+            used = record.total - record.available if record.kind == 'Mem' else record.used
+            values['mem' if record.kind == 'Mem' else 'swap'] = 100.0 * used / record.total
+    for disk in sample.disks:
+        if disk.filesystem not in PSEUDO_FILESYSTEMS and not disk.filesystem.startswith('/dev/loop'):
+            values[f'disk:{disk.mount}'] = disk.use_percent
+    return values
+
+def threshold_level(metric, value, previous):
+    """Уровень 0/1/2 по порогам с гистерезисом: уровень понижается, только когда
+    значение опустится ниже порога на долю ALERT_HYSTERESIS."""
+    warn, crit = HEALTH_THRESHOLDS[metric]
+    level = 2 if value >= crit else 1 if value >= warn else 0
+    if level < previous:
+        if previous == 2 and value > crit * (1 - ALERT_HYSTERESIS):
+            level = 2
+        elif level == 0 and value > warn * (1 - ALERT_HYSTERESIS):
+            level = 1
+    return level
+
+
+class HostMonitor:
+    """История замеров по хостам и состояние оповещений.
+
+    Оповещение отправляется при смене уровня правила (с гистерезисом), а пока
+    правило срабатывает - повторяется не чаще раза в ALERT_REPEAT_INTERVAL.
+    """
+
+    def __init__(self, history_size=MONITOR_HISTORY):
+        self.history_size = history_size
+        self.histories = {}
+        self.latest = {}
+        # (хост, ряд, правило) -> (уровень, время последнего оповещения)
+        self.alert_state = {}
+
+    def fresh_sample(self, host):
+        sample = self.latest.get(host)
+        if sample is None or time.time() - sample.time > MONITOR_MAX_AGE:
+            return None
+        return sample
+
+    def record(self, host, sample):
+        """Сохраняет замер и возвращает тексты сработавших или снятых оповещений."""
+        history = self.histories.get(host)
+        if history is None:
+            history = self.histories[host] = HostHistory(self.history_size)
+        values = sample_values(history, sample)
+        history.append(sample.time, values)
+        self.latest[host] = sample
+        alerts = []
+        for key, value in values.items():
+            metric = key.split(':', 1)[0]
+            level = threshold_level(metric, value, self._level(host, key, 'threshold'))
+            alerts += self._update(host, key, 'threshold', level, value, sample.time)
+            rate_limit = ALERT_RATE_RULES.get(metric)
+            if rate_limit:
+                rate = self.growth_rate(history, key, sample.time)
+                previous = self._level(host, key, 'rate')
+                firing = rate is not None and rate >= rate_limit * (1 - ALERT_HYSTERESIS if previous else 1)
+                alerts += self._update(host, key, 'rate', 2 if firing else 0, rate, sample.time)
+        return alerts
+
+    def _level(self, host, key, rule):
+        return self.alert_state.get((host, key, rule), (0, 0.0))[0]
+
+    @staticmethod
+    def growth_rate(history, key, now):
+        """Рост ряда в пунктах в час за окно ALERT_RATE_WINDOW; None, если данных мало."""
+        points = history.points(key, since=now - ALERT_RATE_WINDOW)
+        if len(points) < 2 or points[-1][0] - points[0][0] < ALERT_RATE_WINDOW / 2:
+            return None
+        (first_time, first), (last_time, last) = points[0], points[-1]
+        return (last - first) / (last_time - first_time) * 3600
+
+    def _update(self, host, key, rule, level, value, now):
+        state_key = (host, key, rule)
+        previous, sent_at = self.alert_state.get(state_key, (0, 0.0))
+        if level == previous and (not level or now - sent_at < ALERT_REPEAT_INTERVAL):
+            return []
+        if level:
+            self.alert_state[state_key] = (level, now)
+        else:
+            self.alert_state.pop(state_key, None)
+        if rule == 'rate':
+            if level:
+                return [f"📈 {host}: {key} растет на {value:.1f} п.п./ч"]
+            return [f"{ALERT_MARKS[0]} {host}: рост {key} прекратился"]
+        if level:
+            warn, crit = HEALTH_THRESHOLDS[key.split(':', 1)[0]]
+            return [f"{ALERT_MARKS[level]} {host}: {key} = {value:.1f} (порог {crit if level == 2 else warn:g})"]
+        return [f"{ALERT_MARKS[0]} {host}: {key} в норме ({value:.1f})"]
+
+    def trend_lines(self, host, keys):
+        history = self.histories.get(host)
+        if history is None:
+            return []
+        lines = []
+        for key in keys:
+            values = [value for _, value in history.points(key)]
+            if values:
+                lines.append(f"  {key}: {sparkline(values)} {values[-1]:.1f}")
+        return lines
+
+
+monitor = HostMonitor()
+
+async def sample_host(host):
+    """Снимает замер хоста по постоянному SSH-соединению; возвращает оповещения."""
+    try:
+        _, output, _ = await run_remote(MONITOR_SCRIPT, host=host)
+        return monitor.record(host, parse_monitor_sample(output, time.time()))
+    except Exception as e:
+        logger.warning("Фоновый опрос %s не удался: %s", host, e)
+        return []
+
+def alert_subscribers(application):
+    """Подписанные чаты и селекторы хостов из chat_data."""
+    return [(chat_id, data['alerts']) for chat_id, data in list(application.chat_data.items()) if data.get('alerts')]
+
+async def monitor_job(context: ContextTypes.DEFAULT_TYPE):
+    """Периодический опрос хостов и рассылка оповещений подписанным чатам."""
+    token = current_handler.set('monitor')
+    try:
+        try:
+            allowed = set(inventory.resolve(MONITOR_HOSTS))
+        except KeyError as e:
+            logger.warning("Неизвестный хост или группа в MONITOR_HOSTS: %s", e.args[0])
+            return
+        subscriptions = []
+        for chat_id, selectors in alert_subscribers(context.application):
+            try:
+                subscriptions.append((chat_id, inventory.resolve(selectors)))
+            except KeyError:
+                continue
+        # Без подписчиков хосты не опрашиваются: SSH-соединения не открываются зря
+        hosts = [host for host in inventory.pools if host in allowed
+                 and any(host in chat_hosts for _, chat_hosts in subscriptions)]
+        if not hosts:
+            return
+        results = dict(await fan_out(hosts, sample_host))
+        for chat_id, chat_hosts in subscriptions:
+            # fan_out возвращает строку вместо списка оповещений, если хост не ответил вовремя
+            lines = [line for host in chat_hosts if isinstance(results.get(host), list) for line in results[host]]
+            if not lines:
+                continue
+            # Ошибка доставки в один чат не должна лишать оповещений остальные
+            try:
+                await send_output(context.bot, chat_id, "\n".join(lines), 'alerts.txt')
+            except Forbidden as e:
+                logger.info("Чат %s недоступен (%s), подписка на оповещения снята.", chat_id, e)
+                context.application.chat_data[chat_id].pop('alerts', None)
+                context.application.mark_data_for_update_persistence(chat_ids=chat_id)
+            except TelegramError as e:
+                logger.warning("Не удалось отправить оповещения в чат %s: %s", chat_id, e)
+    finally:
+        current_handler.reset(token)
+
+# Подписка на оповещения фонового опроса
+async def alerts_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    logger.info("User %s requested /alerts", update.effective_user.id)
+    selectors, args = split_targets(context.args)
+    action = args[0] if args else 'status'
+    if action == 'on':
+        if selectors and await resolve_targets(update, selectors) is None:
+            return
+        context.chat_data['alerts'] = selectors or ['all']
+        await update.message.reply_text(
+            f"Оповещения включены для: {', '.join(context.chat_data['alerts'])}. "
+            f"Опрос каждые {MONITOR_INTERVAL:g} с." if MONITOR_INTERVAL > 0 else
+            "Подписка сохранена, но фоновый опрос выключен (MONITOR_INTERVAL=0)."
+        )
+    elif action == 'off':
+        context.chat_data.pop('alerts', None)
+        await update.message.reply_text("Оповещения выключены.")
+    else:
+        subscribed = context.chat_data.get('alerts')
+        lines = [f"Подписка: {', '.join(subscribed)}" if subscribed else "Подписки нет. Включить: /alerts on [@хост]"]
+        active = [f"{ALERT_MARKS.get(level, '📈')} {host}: {key} ({rule})"
+                  for (host, key, rule), (level, _) in sorted(monitor.alert_state.items())]
+        lines += ["Активные оповещения:"] + active if active else ["Активных оповещений нет."]
+        await update.message.reply_text("\n".join(lines))
+
+def ssh_gauges():
+    gauges = []
+    for name, pool in inventory.pools.items():
+        if isinstance(pool, SSHPool):
+            gauges.append(('ssh_connected', {'host': name}, int(pool._is_alive())))
+            gauges.append(('ssh_channels_active', {'host': name}, pool.active_channels))
+    return gauges
+
+def limiter_gauges():
+    cache = command_cache.stats()
+    return [
+        ('admission_in_flight', {}, admission.in_flight),
+        ('admission_waiting', {}, admission.waiting),
+        ('admission_rejected', {}, admission.rejected),
+        ('rate_buckets', {}, rate_limiter.stats()['buckets']),
+        ('rate_rejected', {}, rate_limiter.rejected),
+        ('cache_entries', {}, cache['entries']),
+        ('cache_hits', {}, cache['hits']),
+        ('cache_misses', {}, cache['misses']),
+        ('output_cache_entries', {}, output_cache.stats()['entries']),
+        ('output_cache_chars', {}, output_cache.stats()['chars']),
+    ]
+
+# Метрики бота (только для администраторов)
+async def bot_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    logger.info("User %s requested /bot_stats", update.effective_user.id)
+    if update.effective_user.id not in ADMIN_IDS:
+        await update.message.reply_text("Команда доступна только администраторам.")
+        return
+    await reply_output(update.message, metrics.render_text(), 'bot_stats.txt')
+
+# Статистика кэша удаленных команд
+async def cache_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    logger.info("User %s requested /cache_stats", update.effective_user.id)
+    stats = command_cache.stats()
+    if context.args and context.args[0] == 'clear':
+        if update.effective_user.id not in ADMIN_IDS:
+            await update.message.reply_text("Очистка кэша доступна только администраторам.")
+            return
+        command_cache.invalidate()
+        logger.info("User %s cleared the command cache", update.effective_user.id)
+    await update.message.reply_text(
+        "Статистика кэша команд:\n"
+        f"Записей: {stats['entries']}\n"
+        f"Попаданий: {stats['hits']}\n"
+        f"Промахов: {stats['misses']}\n"
+        f"Объединенных запросов: {stats['coalesced']}"
+    )
 
 async def verify_password_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Запрашивает пароль для проверки сложности."""
@@ -196,9 +2116,240 @@ async def verify_password(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     logger.info("Processed /verify_password command.")
     return ConversationHandler.END
 
+# Индекс установленных пакетов
+@dataclass(slots=True)
+class PackageInfo:
+    name: str
+    version: str
+    arch: str
+    summary: str
+
+
+VERSION_TOKEN = re.compile(r'([^0-9]*)([0-9]*)')
+VERSION_QUERY = re.compile(r'^([A-Za-z0-9][A-Za-z0-9.+-]*)?\s*(?:(<<|<=|>=|>>|=|<|>)\s*([0-9A-Za-z.+~:-]+))?$')
+VERSION_OPS = {
+    '<<': lambda c: c < 0, '<': lambda c: c < 0, '<=': lambda c: c <= 0, '=': lambda c: c == 0,
+    '>=': lambda c: c >= 0, '>>': lambda c: c > 0, '>': lambda c: c > 0,
+}
+
+def version_char_order(char):
+    """Порядок символа в версии Debian: '~' раньше конца строки, буквы раньше прочих знаков."""
+    if char == '~':
+        return -1
+    if char.isalpha():
+        return ord(char)
+    return ord(char) + 256
+
+def compare_version_part(a, b):
+    """Сравнивает upstream-часть или ревизию по алгоритму dpkg (чередование текста и чисел)."""
+    for (a_text, a_num), (b_text, b_num) in zip_longest(
+        VERSION_TOKEN.findall(a), VERSION_TOKEN.findall(b), fillvalue=('', '')
+    ):
+        a_key = [version_char_order(char) for char in a_text] + [0]
+        b_key = [version_char_order(char) for char in b_text] + [0]
+        if a_key != b_key:
+            return -1 if a_key < b_key else 1
+        a_value, b_value = int(a_num or 0), int(b_num or 0)
+        if a_value != b_value:
+            return -1 if a_value < b_value else 1
+    return 0
+
+def split_version(version):
+    """Разбивает версию Debian на (эпоха, upstream, ревизия)."""
+    epoch, _, rest = version.partition(':') if ':' in version else ('0', '', version)
+    upstream, _, revision = rest.rpartition('-') if '-' in rest else (rest, '', '')
+    return int(epoch or 0), upstream, revision
+
+def compare_versions(a, b):
+    """Сравнение версий пакетов Debian: -1, 0 или 1, как dpkg --compare-versions."""
+    a_epoch, a_upstream, a_revision = split_version(a)
+    b_epoch, b_upstream, b_revision = split_version(b)
+    if a_epoch != b_epoch:
+        return -1 if a_epoch < b_epoch else 1
+    return compare_version_part(a_upstream, b_upstream) or compare_version_part(a_revision, b_revision)
+
+def parse_dpkg_status(text):
+    """Разбирает /var/lib/dpkg/status в записи установленных пакетов."""
+    packages = []
+    for stanza in text.split('\n\n'):
+        fields = {}
+        for line in stanza.splitlines():
+            # Строки продолжения (описание, conffiles) начинаются с пробела
+            if line and not line[0].isspace():
+                key, _, value = line.partition(':')
+                fields[key] = value.strip()
+        if 'Package' in fields and fields.get('Status', '').endswith(' installed'):
+            packages.append(PackageInfo(
+                fields['Package'], fields.get('Version', ''), fields.get('Architecture', ''),
+                fields.get('Description', ''),
+            ))
+    return packages
+
+
+class PackageIndex:
+    """Индекс пакетов одного хоста: сортированный список имен для поиска по префиксу,
+    подстроке и нечеткого поиска."""
+
+    def __init__(self, packages):
+        self.packages = sorted(packages, key=lambda package: (package.name, package.arch))
+        self.names = [package.name for package in self.packages]
+        self.unique_names = list(dict.fromkeys(self.names))
+
+    def _by_names(self, names):
+        result = []
+        for name in names:
+            start = bisect.bisect_left(self.names, name)
+            end = bisect.bisect_right(self.names, name, lo=start)
+            result.extend(self.packages[start:end])
+        return result
+
+    def search(self, name='', op=None, version=None):
+        """Возвращает (пакеты, нечеткий поиск): сначала совпадения по префиксу, затем по подстроке.
+
+        Если точных совпадений нет, подбираются похожие имена (difflib).
+        """
+        fuzzy = False
+        if not name:
+            matches = self.packages
+        else:
+            start = bisect.bisect_left(self.names, name)
+            end = bisect.bisect_left(self.names, name + '\uffff', lo=start)
+            matches = self.packages[start:end] + [
+                package for package in self.packages
+                if name in package.name and not package.name.startswith(name)
+            ]
+            if not matches:
+                fuzzy = True
+                matches = self._by_names(difflib.get_close_matches(
+                    name, self.unique_names, n=PACKAGE_FUZZY_LIMIT, cutoff=PACKAGE_FUZZY_CUTOFF
+                ))
+        if op is not None:
+            check = VERSION_OPS[op]
+            matches = [package for package in matches if check(compare_versions(package.version, version))]
+        return matches, fuzzy
+
+
+class PackageIndexStore:
+    """Индексы пакетов по хостам.
+
+    База dpkg загружается целиком только при изменении ее mtime; проверка
+    mtime выполняется не чаще раза в PACKAGE_CHECK_INTERVAL секунд.
+    """
+
+    def __init__(self, path=PACKAGE_STATUS_PATH, check_interval=PACKAGE_CHECK_INTERVAL):
+        self.path = path
+        self.check_interval = check_interval
+        self._entries = {}
+        self._locks = {}
+
+    async def _run(self, host, command):
+        _, output, error = await run_remote(command, host=host)
+        if error:
+            raise RuntimeError(error)
+        return output
+
+    async def get(self, host, refresh=False):
+        async with self._locks.setdefault(host, asyncio.Lock()):
+            entry = self._entries.get(host)
+            now = time.monotonic()
+            if entry is not None and not refresh and now - entry[1] < self.check_interval:
+                return entry[2]
+            path = shlex.quote(self.path)
+            mtime = await self._run(host, f'stat -c %Y {path}')
+            if entry is not None and entry[0] == mtime:
+                self._entries[host] = (mtime, now, entry[2])
+                return entry[2]
+            output = await self._run(host, f'stat -c %Y {path} && cat {path}')
+            mtime, _, text = output.partition('\n')
+            index = PackageIndex(await run_blocking(parse_dpkg_status, text))
+            self._entries[host] = (mtime, now, index)
+            logger.info("Индекс пакетов %s обновлен: %s пакетов", host, len(index.packages))
+            return index
+
+
+package_indexes = PackageIndexStore()
+
+def parse_package_query(text):
+    """Разбирает запрос вида "имя", "имя >= версия" или ">= версия"; None при ошибке."""
+    match = VERSION_QUERY.match(text.strip())
+    if match is None or not any(match.groups()):
+        return None
+    name, op, version = match.groups()
+    # Имена пакетов Debian всегда в нижнем регистре, версии - с учетом регистра
+    return (name or '').lower(), op, version
+
+async def load_package_index(host, refresh=False):
+    """Индекс пакетов хоста или текст ошибки для сводного отчета."""
+    try:
+        return await package_indexes.get(host, refresh)
+    except Exception as e:
+        logger.warning("Не удалось получить список пакетов %s: %s", host, e)
+        return f"не удалось получить список пакетов: {e}"
+
+async def search_packages(hosts, query, refresh=False):
+    """Ищет пакеты по индексам хостов; возвращает (строки, нечеткий поиск, ошибки)."""
+    results = await fan_out(hosts, lambda host: load_package_index(host, refresh))
+    lines, errors, fuzzy = [], [], False
+    for host, index in results:
+        if not isinstance(index, PackageIndex):
+            errors.append(f"{host}: {index}")
+            continue
+        packages, host_fuzzy = index.search(*query)
+        fuzzy = fuzzy or host_fuzzy
+        prefix = f"{host}: " if len(hosts) > 1 else ""
+        lines.extend(f"{prefix}{p.name} {p.version} {p.arch} - {p.summary}" for p in packages)
+    return lines, fuzzy, errors
+
+def packages_keyboard(page, pages):
+    """Клавиатура навигации по страницам результатов поиска пакетов."""
+    row = []
+    if page > 0:
+        row.append(InlineKeyboardButton('◀ Назад', callback_data=f'apt:{page - 1}'))
+    if page + 1 < pages:
+        row.append(InlineKeyboardButton('Вперед ▶', callback_data=f'apt:{page + 1}'))
+    return InlineKeyboardMarkup([row]) if row else None
+
+async def render_packages_page(search, page):
+    """Формирует текст и клавиатуру страницы результатов по сохраненному запросу."""
+    lines, fuzzy, errors = await search_packages(search['hosts'], search['query'], search.get('refresh', False))
+    # Повторная навигация не должна снова принудительно проверять хосты
+    search['refresh'] = False
+    if not lines:
+        return "\n".join(["Пакеты не найдены среди установленных."] + errors), None
+    pages = -(-len(lines) // PACKAGE_PAGE_SIZE)
+    page = min(max(page, 0), pages - 1)
+    title = "Точных совпадений нет, похожие пакеты" if fuzzy else "Установленные пакеты"
+    body = fit_page(lines[page * PACKAGE_PAGE_SIZE:(page + 1) * PACKAGE_PAGE_SIZE], 3500)
+    text = "\n".join([f"{title} ({len(lines)}), стр. {page + 1}/{pages}:"] + body + errors)
+    return text, packages_keyboard(page, pages)
+
+async def reply_packages(update: Update, context: ContextTypes.DEFAULT_TYPE, query):
+    """Выполняет поиск по индексу и отправляет первую страницу результатов."""
+    hosts = await resolve_targets(update, context.user_data.pop('apt_targets', []))
+    if hosts is None:
+        return
+    search = {'hosts': hosts, 'query': list(query), 'refresh': context.user_data.pop('apt_refresh', False)}
+    context.user_data['apt_search'] = search
+    text, keyboard = await render_packages_page(search, 0)
+    await update.message.reply_text(text, reply_markup=keyboard)
+
+@limited('ssh')
+async def packages_page_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработка кнопок навигации по результатам /get_apt_list."""
+    query = update.callback_query
+    search = context.user_data.get('apt_search')
+    if search is None:
+        await query.answer("Страница устарела, повторите команду.", show_alert=True)
+        return
+    await query.answer()
+    text, keyboard = await render_packages_page(search, int(query.data.split(':')[1]))
+    await query.edit_message_text(text, reply_markup=keyboard)
+
 # Начало разговора с пользователем
 async def get_apt_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    logger.info(f"User {update.effective_user.id} requested /get_apt_list")
+    logger.info("User %s requested /get_apt_list", update.effective_user.id)
+    context.user_data['apt_targets'], _ = split_targets(context.args)
+    context.user_data['apt_refresh'] = wants_refresh(context)
     await update.message.reply_text(
         "Выберите опцию:\n"
         "1. Вывести список всех установленных пакетов\n"
@@ -208,25 +2359,23 @@ async def get_apt_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
     return APT_LIST_CHOICE
 
+@limited('ssh')
+async def apt_list_all(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Вывод всех установленных пакетов; токены списываются только за этот вариант выбора."""
+    logger.info("User %s chose to list all packages", update.effective_user.id)
+    await reply_packages(update, context, ('', None, None))
+    return ConversationHandler.END
+
 # Обработка выбора пользователя
 async def apt_list_choice(update: Update, context: ContextTypes.DEFAULT_TYPE):
     choice = update.message.text.strip()
     if choice == '1':
-        logger.info(f"User {update.effective_user.id} chose to list all packages")
-        response = execute_ssh_command('dpkg -l')
-
-        # Проверяем длину ответа
-        if len(response) < 4096:
-            await update.message.reply_text(response)
-        else:
-            # Отправляем как файл, если сообщение слишком длинное
-            with open('apt_list.txt', 'w') as f:
-                f.write(response)
-            await update.message.reply_document(document=open('apt_list.txt', 'rb'))
-            os.remove('apt_list.txt')  # Удаляем файл после отправки
-        return ConversationHandler.END
+        return await apt_list_all(update, context)
     elif choice == '2':
-        await update.message.reply_text("Введите название пакета для поиска:")
+        await update.message.reply_text(
+            "Введите название пакета или его часть. Можно добавить условие на версию, "
+            "например: openssl >= 3.0"
+        )
         return APT_PACKAGE_NAME
     else:
         await update.message.reply_text("Пожалуйста, введите *1* или *2*. Для отмены введите /cancel.",
@@ -234,134 +2383,416 @@ async def apt_list_choice(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return APT_LIST_CHOICE
 
 # Обработка поиска пакета
+@limited('ssh')
 async def apt_package_search(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    package_name = update.message.text.strip()
-    logger.info(f"User {update.effective_user.id} searched for package {package_name}")
-    response = execute_ssh_command(f'dpkg -l | grep -i {package_name}')
-    if response:
-        await update.message.reply_text(response)
-    else:
-        await update.message.reply_text(f"Пакет *{package_name}* не найден среди установленных.", parse_mode='Markdown')
+    text = update.message.text.strip()
+    query = parse_package_query(text)
+    if query is None:
+        await update.message.reply_text(
+            "Некорректный запрос. Укажите имя пакета и, при необходимости, условие на версию "
+            "(<<, <=, =, >=, >>), например: libssl >= 3.0"
+        )
+        return APT_PACKAGE_NAME
+    logger.info("User %s searched for package %s", update.effective_user.id, text)
+    await reply_packages(update, context, query)
     return ConversationHandler.END
 
+def rotated_log_segments(path):
+    """Ротированные части журнала от новых к старым: path.1, path.2.gz, ..."""
+    segments = []
+    for candidate in glob.glob(glob.escape(path) + '.*'):
+        match = re.fullmatch(r'\.(\d+)(\.gz)?', candidate[len(path):])
+        if match:
+            segments.append((int(match.group(1)), candidate))
+    return [candidate for _, candidate in sorted(segments)]
+
+def tail_matching_lines(path, pattern, count, block_size=REPL_LOG_BLOCK_SIZE):
+    """Читает файл блоками с конца и возвращает последние count строк, подходящих под pattern."""
+    found = []
+    with open(path, 'rb') as f:
+        position = f.seek(0, os.SEEK_END)
+        remainder = b''
+        while position > 0 and len(found) < count:
+            read_size = min(block_size, position)
+            position -= read_size
+            f.seek(position)
+            lines = (f.read(read_size) + remainder).split(b'\n')
+            # Первая строка блока может быть неполной, она дочитывается со следующим блоком
+            remainder = lines.pop(0) if position > 0 else b''
+            for line in reversed(lines):
+                if pattern.search(line):
+                    found.append(line)
+                    if len(found) == count:
+                        break
+    found.reverse()
+    return found
+
+def grep_compressed_lines(path, pattern, count):
+    """Последние count подходящих строк сжатого сегмента (gzip читается только последовательно)."""
+    found = deque(maxlen=count)
+    with gzip.open(path, 'rb') as f:
+        for line in f:
+            if pattern.search(line):
+                found.append(line.rstrip(b'\n'))
+    return list(found)
+
+def read_repl_log(path=REPL_LOG_PATH, pattern=REPL_LOG_PATTERN, count=REPL_LOG_LINES):
+    """Последние count строк о репликации с учетом ротированных частей журнала."""
+    lines = []
+    for segment in [path] + rotated_log_segments(path):
+        need = count - len(lines)
+        if need <= 0:
+            break
+        try:
+            if segment.endswith('.gz'):
+                older = grep_compressed_lines(segment, pattern, need)
+            else:
+                older = tail_matching_lines(segment, pattern, need)
+        except FileNotFoundError:
+            # Файл мог быть ротирован между поиском сегментов и чтением
+            continue
+        lines = older + lines
+    return [line.decode('utf-8', errors='replace') for line in lines]
+
+def read_log_increment(state):
+    """Читает новые строки журнала начиная с сохраненного смещения.
+
+    state хранит путь, inode и смещение; при ротации дочитывается хвост
+    прежнего файла (path.1), после чего чтение продолжается с начала нового.
+    """
+    path = state['path']
+    chunks = []
+    stat = os.stat(path)
+    if stat.st_ino != state['inode'] or stat.st_size < state['offset']:
+        rotated = path + '.1'
+        if os.path.exists(rotated) and os.stat(rotated).st_ino == state['inode']:
+            with open(rotated, 'rb') as f:
+                f.seek(state['offset'])
+                chunks.append(f.read(REPL_FOLLOW_MAX_BYTES))
+        state['inode'] = stat.st_ino
+        state['offset'] = 0
+    with open(path, 'rb') as f:
+        f.seek(state['offset'])
+        data = f.read(REPL_FOLLOW_MAX_BYTES)
+    # Незавершенная последняя строка будет прочитана в следующий раз
+    complete = data.rfind(b'\n') + 1
+    state['offset'] += complete
+    chunks.append(data[:complete])
+    return [
+        line.decode('utf-8', errors='replace')
+        for chunk in chunks
+        for line in chunk.split(b'\n')
+        if state['pattern'].search(line)
+    ]
+
+async def follow_repl_logs_job(context: ContextTypes.DEFAULT_TYPE):
+    """Периодически отправляет в чат новые строки о репликации."""
+    state = context.job.data
+    try:
+        lines = await run_blocking(read_log_increment, state)
+    except OSError as e:
+        logger.warning("Не удалось прочитать журнал репликации: %s", e)
+        return
+    if lines:
+        await send_output(context.bot, context.job.chat_id, "\n".join(lines), 'repl_logs.txt')
+
+@limited('cpu')
 async def get_repl_logs(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработчик команды /get_repl_logs для получения файла логов."""
+    """Обработчик команды /get_repl_logs для получения файла логов.
+
+    Аргументы: число строк, follow - присылать новые строки, stop - прекратить.
+    """
     logger.info("Пользователь запросил репликационные логи.")
+    args = context.args or []
+    chat_id = update.effective_chat.id
+    job_name = f'repl_follow:{chat_id}'
     try:
-        logger.info(f"Выполнение команды: /get_repl_logs")
-
-        log_data = subprocess.run(
-            ["bash", "-c", f"cat /var/log/postgresql/postgresql.log | grep repl | tail -n 15"],
-            capture_output=True,
-            text=True
-        ).stdout
-        if log_data:
-            await update.message.reply_text(f"Последние репликационные логи:\n{log_data}")
+        logger.info("Выполнение команды: /get_repl_logs %s", ' '.join(args))
+        if args and args[0] in ('follow', 'stop'):
+            if context.job_queue is None:
+                await update.message.reply_text("Режим слежения недоступен: не установлен python-telegram-bot[job-queue].")
+                return
+            for job in context.job_queue.get_jobs_by_name(job_name):
+                job.schedule_removal()
+            if args[0] == 'stop':
+                await update.message.reply_text("Слежение за репликационными логами остановлено.")
+                return
+            stat = await run_blocking(os.stat, REPL_LOG_PATH)
+            state = {'path': REPL_LOG_PATH, 'pattern': REPL_LOG_PATTERN, 'inode': stat.st_ino, 'offset': stat.st_size}
+            context.job_queue.run_repeating(
+                follow_repl_logs_job, REPL_FOLLOW_INTERVAL, chat_id=chat_id, name=job_name, data=state
+            )
+            await update.message.reply_text("Новые репликационные логи будут присылаться в этот чат. Для остановки: /get_repl_logs stop")
+            return
+
+        count = min(int(args[0]), REPL_LOG_MAX_LINES) if args and args[0].isdigit() else REPL_LOG_LINES
+        lines = await run_blocking(read_repl_log, count=count)
+        if lines:
+            await reply_output(
+                update.message, "Последние репликационные логи:\n" + "\n".join(lines), 'repl_logs.txt'
+            )
         else:
-            await update.message.reply_text("Файл логов пуст.")
-    except paramiko.SSHException as pe:
-        logger.error(f"Ошибка SSH-соединения: {pe}")
-        await update.message.reply_text("Не удалось установить SSH-соединение. Проверьте настройки подключения.")
+            await update.message.reply_text("Записей о репликации в журнале не найдено.")
+    except FileNotFoundError:
+        logger.error("Файл журнала %s не найден.", REPL_LOG_PATH)
+        await update.message.reply_text("Файл логов не найден. Проверьте настройку REPL_LOG_PATH.")
     except Exception as e:
         logger.exception("Ошибка при получении репликационных логов.")
         await update.message.reply_text(f"Ошибка при получении репликационных логов: {e}")
 
+# Поиск совпадений в больших текстах и документах
+EXTRACT_PATTERNS = {'emails': EMAIL_REGEX, 'phones': PHONE_REGEX}
+EXTRACT_MESSAGES = {
+    'emails': {
+        'found': "Найдены следующие email-адреса",
+        'none': "В предоставленном тексте не найдено email-адресов.",
+    },
+    'phones': {
+        'found': "Найдены следующие номера телефонов",
+        'none': "В предоставленном тексте не найдено номеров телефонов.",
+    },
+}
+GZIP_MAGIC = b'\x1f\x8b'
+NON_DIGITS = re.compile(r'[^0-9]')
+_extract_executor = None
+
+def iter_text_chunks(data, chunk_size=EXTRACT_CHUNK_SIZE):
+    """Потоково декодирует документ (в том числе gzip) фрагментами текста."""
+    stream = io.BytesIO(data)
+    if data[:2] == GZIP_MAGIC:
+        stream = gzip.GzipFile(fileobj=stream)
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    while True:
+        block = stream.read(chunk_size)
+        if not block:
+            break
+        yield decoder.decode(block)
+    yield decoder.decode(b'', final=True)
+
+def extract_stream(chunks, pattern, overlap=EXTRACT_OVERLAP):
+    """Считает совпадения в потоке фрагментов текста.
+
+    Совпадение, заканчивающееся в последних overlap символах буфера, может
+    продолжиться в следующем фрагменте, поэтому его разбор откладывается.
+    Совпадения длиннее overlap на стыке фрагментов могут быть разрезаны.
+    """
+    counts = Counter()
+    carry = ''
+    for chunk in chunks:
+        buffer = carry + chunk
+        safe_end = len(buffer) - overlap
+        keep_from = max(safe_end, 0)
+        for match in pattern.finditer(buffer):
+            if match.end() > safe_end:
+                keep_from = match.start()
+                break
+            counts[match.group()] += 1
+        carry = buffer[keep_from:]
+    counts.update(pattern.findall(carry))
+    return counts
+
+def normalize_phone(raw):
+    """Приводит номер к формату E.164: +7XXXXXXXXXX."""
+    return '+7' + NON_DIGITS.sub('', raw)[-10:]
+
+def normalize_email(raw):
+    """Приводит адрес к нижнему регистру, домен - к ASCII-форме IDNA."""
+    local, _, domain = raw.rpartition('@')
+    domain = domain.lower()
+    try:
+        domain = domain.encode('idna').decode('ascii')
+    except UnicodeError:
+        pass
+    return f"{local.lower()}@{domain}"
+
+NORMALIZERS = {'emails': normalize_email, 'phones': normalize_phone}
+
+def canonicalize_matches(counts, kind):
+    """Группирует найденные строки по канонической форме: {каноническая: {исходная: число}}."""
+    normalize = NORMALIZERS[kind]
+    groups = {}
+    for raw, count in counts.items():
+        groups.setdefault(normalize(raw), {})[raw] = count
+    return groups
+
+def format_match_group(canonical, originals):
+    """Каноническая форма и исходные написания, если они отличаются от нее."""
+    variants = [raw for raw in originals if raw != canonical]
+    return f"{canonical} ({', '.join(variants)})" if variants else canonical
+
+def extract_matches(data, kind):
+    """Извлекает и нормализует совпадения из документа. Для больших файлов выполняется в отдельном процессе."""
+    return canonicalize_matches(extract_stream(iter_text_chunks(data), EXTRACT_PATTERNS[kind]), kind)
+
+def get_extract_executor():
+    """Пул процессов создается при первом большом документе.
+
+    Рабочие процессы не наследуют fork'ом состояние бота (потоки логирования,
+    сокеты, блокировки), а запускаются чистыми через forkserver или spawn.
+    """
+    global _extract_executor
+    if _extract_executor is None:
+        method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+        _extract_executor = ProcessPoolExecutor(
+            max_workers=EXTRACT_PROCESSES, mp_context=multiprocessing.get_context(method)
+        )
+    return _extract_executor
+
+async def extract_from_document(data, kind):
+    """Извлекает совпадения, не блокируя цикл событий: большие документы - в пуле процессов."""
+    if len(data) >= EXTRACT_PROCESS_THRESHOLD:
+        loop = asyncio.get_running_loop()
+        async with admission.slot():
+            return await loop.run_in_executor(get_extract_executor(), extract_matches, data, kind)
+    return await run_blocking(extract_matches, data, kind)
+
+async def present_matches(update: Update, context: ContextTypes.DEFAULT_TYPE, kind, groups):
+    """Показывает найденные совпадения и предлагает сохранить их; возвращает следующее состояние.
+
+    groups - результат canonicalize_matches: в базу сохраняются канонические формы.
+    """
+    messages = EXTRACT_MESSAGES[kind]
+    if not groups:
+        await update.message.reply_text(messages['none'])
+        return ConversationHandler.END
+    context.user_data[kind] = list(groups)
+    total = sum(sum(originals.values()) for originals in groups.values())
+    header = f"{messages['found']} (всего совпадений: {total}, уникальных: {len(groups)}):\n"
+    footer = "\n\nХотите сохранить их в базу данных? (да/нет)"
+    body = "\n".join(format_match_group(canonical, originals) for canonical, originals in groups.items())
+    if len(header) + len(body) + len(footer) <= 4096:
+        await update.message.reply_text(header + body + footer)
+    else:
+        await reply_output(update.message, header + body, f'{kind}.txt')
+        await update.message.reply_text(footer.strip())
+    return CONFIRM_EMAIL if kind == 'emails' else CONFIRM_PHONE
+
+async def receive_document(update: Update, context: ContextTypes.DEFAULT_TYPE, kind):
+    """Получение документа (txt, csv, gzip) и поиск совпадений в нем."""
+    document = update.message.document
+    logger.info("User %s sent document %s (%s bytes) for %s",
+                update.effective_user.id, document.file_name, document.file_size, kind)
+    if document.file_size and document.file_size > EXTRACT_MAX_FILE_SIZE:
+        await update.message.reply_text(
+            f"Файл слишком большой: максимум {EXTRACT_MAX_FILE_SIZE // (1024 * 1024)} МБ."
+        )
+        return ConversationHandler.END
+    file = await document.get_file()
+    data = bytes(await file.download_as_bytearray())
+    started = time.perf_counter()
+    groups = await extract_from_document(data, kind)
+    logger.info("Extracted %s unique %s from %s bytes in %.2fs",
+                len(groups), kind, len(data), time.perf_counter() - started)
+    return await present_matches(update, context, kind, groups)
+
 async def start_get_emails(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Начало процесса поиска Email-адресов."""
     await update.message.reply_text(
-        "Пожалуйста, отправьте текст для поиска email-адресов.",
+        "Пожалуйста, отправьте текст или файл (txt, csv, gz) для поиска email-адресов.",
         reply_markup=ReplyKeyboardRemove()
     )
     return GET_EMAILS_TEXT
 
+@limited('cpu')
 async def receive_emails_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Получение текста и поиск Email-адресов."""
-    text = update.message.text
-    emails = list(set(EMAIL_REGEX.findall(text)))
-    if not emails:
-        await update.message.reply_text("В предоставленном тексте не найдено email-адресов.")
-        return ConversationHandler.END
-    message = (
-        "Найдены следующие email-адреса:\n"
-        + "\n".join(emails)
-        + "\n\nХотите сохранить их в базу данных? (да/нет)"
-    )
-    context.user_data['emails'] = emails
-    await update.message.reply_text(message)
-    return CONFIRM_EMAIL
+    groups = canonicalize_matches(Counter(EMAIL_REGEX.findall(update.message.text)), 'emails')
+    return await present_matches(update, context, 'emails', groups)
 
+@limited('cpu')
+async def receive_emails_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Получение документа и поиск Email-адресов."""
+    return await receive_document(update, context, 'emails')
+
+async def insert_values(conn, table, column, values, bulk=False):
+    """Вставляет значения, пропуская уже существующие; возвращает число новых строк."""
+    if not bulk:
+        status = await conn.execute(SQL_INSERT_ARRAY.format(table=table, column=column), values)
+    else:
+        async with conn.transaction():
+            await conn.execute(SQL_CREATE_STAGING)
+            await conn.copy_records_to_table('contact_staging', records=[(value,) for value in values])
+            status = await conn.execute(SQL_INSERT_STAGING.format(table=table, column=column))
+    return int(status.split()[-1])
+
+async def save_contacts(pool, kind, values):
+    """Сохраняет значения в таблицу; при большом объеме использует COPY.
+
+    Возвращает (новых, дубликатов).
+    """
+    table = CONTACT_TABLES[kind]
+    bulk = len(values) >= DB_BULK_THRESHOLD
+    with metrics.timer('db'):
+        async with admission.slot(), pool.acquire() as conn:
+            inserted = await insert_values(conn, table['table'], table['column'], values, bulk)
+    logger.info("Saved %s of %s %s (%s)", inserted, len(values), kind, 'COPY' if bulk else 'INSERT')
+    return inserted, len(values) - inserted
+
+@limited('db')
 async def confirm_emails(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Подтверждение сохранения найденных Email-адресов в базе данных."""
     response = update.message.text.lower()
     if response in ['да', 'д', 'yes', 'y']:
-        emails = context.user_data.get('emails', [])
         try:
-            conn = await asyncpg.connect(
-                user=DB_USER,
-                password=DB_PASSWORD,
-                database=DB_DATABASE,
-                host=DB_HOST,
-                port=DB_PORT,
+            inserted, duplicates = await save_contacts(
+                await get_db_pool(context.application), 'emails', context.user_data.get('emails', [])
             )
-            await conn.executemany(
-                'INSERT INTO emails(email) VALUES($1) ON CONFLICT DO NOTHING',
-                [(email,) for email in emails]
+            await update.message.reply_text(
+                f"Email-адреса сохранены в базу данных. Новых: {inserted}, уже были в базе: {duplicates}."
             )
-            await conn.close()
-            await update.message.reply_text("Email-адреса успешно сохранены в базу данных.")
+        except AdmissionRejected as e:
+            # Найденные значения сохраняются: пользователь может повторить ответ позже
+            await update.message.reply_text(str(e))
+            return None
         except Exception as e:
             await update.message.reply_text(f"Ошибка при сохранении в базу данных: {e}")
     else:
         await update.message.reply_text("Операция отменена. Email-адреса не были сохранены.")
+    # Найденные значения больше не нужны ни после сохранения, ни после отказа
+    context.user_data.pop('emails', None)
     return ConversationHandler.END
 
 async def start_get_phones(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Начало процесса поиска номеров телефонов."""
     await update.message.reply_text(
-        "Пожалуйста, отправьте текст для поиска номеров телефонов.",
+        "Пожалуйста, отправьте текст или файл (txt, csv, gz) для поиска номеров телефонов.",
         reply_markup=ReplyKeyboardRemove()
     )
     return GET_PHONES_TEXT
 
+@limited('cpu')
 async def receive_phones_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Получение текста и поиск номеров телефонов."""
-    text = update.message.text
-    phones = list(set(PHONE_REGEX.findall(text)))
-    if not phones:
-        await update.message.reply_text("В предоставленном тексте не найдено номеров телефонов.")
-        return ConversationHandler.END
-    message = (
-        "Найдены следующие номера телефонов:\n"
-        + "\n".join(phones)
-        + "\n\nХотите сохранить их в базу данных? (да/нет)"
-    )
-    context.user_data['phones'] = phones
-    await update.message.reply_text(message)
-    return CONFIRM_PHONE
+    groups = canonicalize_matches(Counter(PHONE_REGEX.findall(update.message.text)), 'phones')
+    return await present_matches(update, context, 'phones', groups)
+
+@limited('cpu')
+async def receive_phones_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Получение документа и поиск номеров телефонов."""
+    return await receive_document(update, context, 'phones')
 
+@limited('db')
 async def confirm_phones(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Подтверждение сохранения найденных номеров телефонов в базе данных."""
     response = update.message.text.lower()
     if response in ['да', 'д', 'yes', 'y']:
-        phones = context.user_data.get('phones', [])
         try:
-            conn = await asyncpg.connect(
-                user=DB_USER,
-                password=DB_PASSWORD,
-                database=DB_DATABASE,
-                host=DB_HOST,
-                port=DB_PORT,
+            inserted, duplicates = await save_contacts(
+                await get_db_pool(context.application), 'phones', context.user_data.get('phones', [])
             )
-            await conn.executemany(
-                'INSERT INTO phones(phone_number) VALUES($1) ON CONFLICT DO NOTHING',
-                [(phone,) for phone in phones]
+            await update.message.reply_text(
+                f"Номера телефонов сохранены в базу данных. Новых: {inserted}, уже были в базе: {duplicates}."
             )
-            await conn.close()
-            await update.message.reply_text("Номера телефонов успешно сохранены в базу данных.")
+        except AdmissionRejected as e:
+            # Найденные значения сохраняются: пользователь может повторить ответ позже
+            await update.message.reply_text(str(e))
+            return None
         except Exception as e:
             await update.message.reply_text(f"Ошибка при сохранении в базу данных: {e}")
     else:
         await update.message.reply_text("Операция отменена. Номера телефонов не были сохранены.")
+    # Найденные значения больше не нужны ни после сохранения, ни после отказа
+    context.user_data.pop('phones', None)
     return ConversationHandler.END
 
 async def find_emails_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -372,177 +2803,687 @@ async def find_phone_numbers_command(update: Update, context: ContextTypes.DEFAU
     """Обработчик команды /find_phone_number."""
     return await start_get_phones(update, context)
 
-async def get_emails_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработчик команды /get_emails для вывода данных из таблицы emails."""
-    logger.info("Пользователь запросил список email-адресов.")
+def fit_page(values, limit=4000):
+    """Отбрасывает хвост страницы, не помещающийся в одно сообщение Telegram."""
+    size = 0
+    for i, value in enumerate(values):
+        size += len(value) + 1
+        if size > limit:
+            return values[:i]
+    return values
+
+async def fetch_contacts_page(pool, kind, direction, boundary=None):
+    """Получает страницу записей по ключу через серверный курсор.
+
+    Возвращает (значения, есть_предыдущая, есть_следующая).
+    """
+    queries = CONTACT_TABLES[kind]['queries']
+    args = () if direction == 'first' else (boundary,)
+    with metrics.timer('db'):
+        async with admission.slot(), pool.acquire() as conn:
+            async with conn.transaction():
+                cursor = await conn.cursor(queries[direction], *args, DB_PAGE_SIZE + 1)
+                rows = [record[0] for record in await cursor.fetch(DB_PAGE_SIZE + 1)]
+    has_more = len(rows) > DB_PAGE_SIZE
+    rows = rows[:DB_PAGE_SIZE]
+    values = fit_page(rows)
+    if direction == 'prev':
+        # Строки получены в обратном порядке: ближайшие к границе идут первыми
+        return values[::-1], has_more or len(values) < len(rows), True
+    return values, direction == 'next', has_more or len(values) < len(rows)
+
+def contacts_keyboard(kind, has_prev, has_next):
+    """Клавиатура навигации по страницам таблицы."""
+    row = []
+    if has_prev:
+        row.append(InlineKeyboardButton('◀ Назад', callback_data=f'contacts:{kind}:prev'))
+    if has_next:
+        row.append(InlineKeyboardButton('Вперед ▶', callback_data=f'contacts:{kind}:next'))
+    download = [InlineKeyboardButton('Скачать все', callback_data=f'contacts:{kind}:all')]
+    return InlineKeyboardMarkup([row, download] if row else [download])
+
+def remember_page(context, kind, message_id, values):
+    """Запоминает границы страницы для конкретного сообщения.
+
+    Ключ включает id сообщения, поэтому кнопки старых сообщений листают свою
+    выдачу, а не последнюю. Хранятся только DB_PAGES_KEPT последних сообщений.
+    """
+    pages = context.user_data.setdefault('pages', {})
+    key = f'{kind}:{message_id}'
+    pages.pop(key, None)
+    pages[key] = [values[0], values[-1]]
+    while len(pages) > DB_PAGES_KEPT:
+        del pages[next(iter(pages))]
+
+async def send_contacts_page(update: Update, context: ContextTypes.DEFAULT_TYPE, kind):
+    """Выводит первую страницу таблицы с кнопками навигации."""
+    table = CONTACT_TABLES[kind]
     try:
-        conn = await asyncpg.connect(
-            user=DB_USER,
-            password=DB_PASSWORD,
-            host=DB_HOST,
-            port=DB_PORT,
-            database=DB_DATABASE
-        )
-        records = await conn.fetch("SELECT email FROM emails;")
-        await conn.close()
-
-        if records:
-            emails = [record['email'] for record in records]
-            formatted_emails = "\n".join(emails)
-            if len(formatted_emails) > 4000:
-                # Telegram ограничение на длину сообщения
-                await update.message.reply_text("Слишком много email-адресов для отправки в одном сообщении.")
-            else:
-                await update.message.reply_text(f"Список email-адресов:\n{formatted_emails}")
+        values, has_prev, has_next = await fetch_contacts_page(await get_db_pool(context.application), kind, 'first')
+        if values:
+            message = await update.message.reply_text(
+                f"{table['title']}:\n" + "\n".join(values),
+                reply_markup=contacts_keyboard(kind, has_prev, has_next),
+            )
+            remember_page(context, kind, message.message_id, values)
         else:
-            await update.message.reply_text("Таблица email-адресов пуста.")
+            await update.message.reply_text(table['empty'])
+    except AdmissionRejected as e:
+        await update.message.reply_text(str(e))
+    except Exception as e:
+        logger.exception("Ошибка при получении данных из таблицы %s.", kind)
+        await update.message.reply_text(f"{table['error']}: {e}")
+
+async def export_contacts(pool, kind):
+    """Потоково выгружает всю таблицу в сжатый документ в памяти."""
+    buffer = io.BytesIO()
+    with metrics.timer('db'):
+        async with admission.slot(), pool.acquire() as conn:
+            async with conn.transaction():
+                cursor = await conn.cursor(CONTACT_TABLES[kind]['queries']['all'])
+                with gzip.GzipFile(fileobj=buffer, mode='wb') as archive:
+                    while True:
+                        chunk = await cursor.fetch(DB_EXPORT_CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        archive.write(("\n".join(record[0] for record in chunk) + "\n").encode('utf-8'))
+    buffer.seek(0)
+    return buffer
+
+@limited('db')
+async def contacts_page_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработка кнопок навигации и выгрузки для /get_emails и /get_phone_numbers."""
+    query = update.callback_query
+    # Формат данных проверен шаблоном обработчика: contacts:(emails|phones):(prev|next|all)
+    _, kind, action = query.data.split(':')
+    table = CONTACT_TABLES[kind]
+    try:
+        pool = await get_db_pool(context.application)
+        if action == 'all':
+            await query.answer("Подготовка файла...")
+            document = await export_contacts(pool, kind)
+            await query.message.reply_document(document=document, filename=f'{kind}.txt.gz')
+            return
+        bounds = context.user_data.get('pages', {}).get(f'{kind}:{query.message.message_id}')
+        if bounds is None:
+            await query.answer("Страница устарела, повторите команду.", show_alert=True)
+            return
+        boundary = bounds[0] if action == 'prev' else bounds[1]
+        values, has_prev, has_next = await fetch_contacts_page(pool, kind, action, boundary)
+        if not values:
+            await query.answer("Больше записей нет.")
+            return
+        await query.answer()
+        remember_page(context, kind, query.message.message_id, values)
+        await query.edit_message_text(
+            f"{table['title']}:\n" + "\n".join(values),
+            reply_markup=contacts_keyboard(kind, has_prev, has_next),
+        )
+    except AdmissionRejected as e:
+        # Для выгрузки на запрос уже ответили, поэтому отказ отправляется сообщением
+        await query.message.reply_text(str(e))
     except Exception as e:
-        logger.exception("Ошибка при получении email-адресов из базы данных.")
-        await update.message.reply_text(f"Ошибка при получении email-адресов: {e}")
+        logger.exception("Ошибка при навигации по таблице %s.", kind)
+        await query.message.reply_text(f"{table['error']}: {e}")
+
+@limited('db')
+async def get_emails_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик команды /get_emails для вывода данных из таблицы emails."""
+    logger.info("Пользователь запросил список email-адресов.")
+    await send_contacts_page(update, context, 'emails')
 
+@limited('db')
 async def get_phone_numbers_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /get_phone_numbers для вывода данных из таблицы phones."""
     logger.info("Пользователь запросил список номеров телефонов.")
-    try:
-        conn = await asyncpg.connect(
-            user=DB_USER,
-            password=DB_PASSWORD,
-            host=DB_HOST,
-            port=DB_PORT,
-            database=DB_DATABASE
+    await send_contacts_page(update, context, 'phones')
+
+class SQLitePersistence(BasePersistence):
+    """Хранение user_data, chat_data и состояний диалогов в SQLite.
+
+    Изменения копятся в памяти и записываются одной транзакцией спустя
+    write_delay секунд после первого изменения, поэтому обработка обновлений
+    не ждет диска. Записи user_data старше USER_DATA_TTL и диалоги старше
+    CONVERSATION_TIMEOUT при загрузке не восстанавливаются и удаляются при
+    периодической очистке; chat_data (подписки на оповещения) хранится без срока,
+    пустые chat_data не записываются.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS user_data (
+            user_id INTEGER PRIMARY KEY, data TEXT NOT NULL, updated REAL NOT NULL);
+        CREATE TABLE IF NOT EXISTS chat_data (
+            chat_id INTEGER PRIMARY KEY, data TEXT NOT NULL, updated REAL NOT NULL);
+        CREATE TABLE IF NOT EXISTS conversations (
+            name TEXT NOT NULL, key TEXT NOT NULL, state TEXT NOT NULL, updated REAL NOT NULL,
+            PRIMARY KEY (name, key));
+    """
+
+    def __init__(self, path, update_interval=PERSISTENCE_UPDATE_INTERVAL, write_delay=PERSISTENCE_WRITE_DELAY):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=True, user_data=True, callback_data=False),
+            update_interval=update_interval,
         )
-        records = await conn.fetch("SELECT phone_number FROM phones;")
-        await conn.close()
-
-        if records:
-            phone_numbers = [record['phone_number'] for record in records]
-            formatted_phones = "\n".join(phone_numbers)
-            if len(formatted_phones) > 4000:
-                # Telegram ограничение на длину сообщения
-                await update.message.reply_text("Слишком много номеров телефонов для отправки в одном сообщении.")
-            else:
-                await update.message.reply_text(f"Список номеров телефонов:\n{formatted_phones}")
-        else:
-            await update.message.reply_text("Таблица номеров телефонов пуста.")
-    except Exception as e:
-        logger.exception("Ошибка при получении номеров телефонов из базы данных.")
-        await update.message.reply_text(f"Ошибка при получении номеров телефонов: {e}")
+        self.path = path
+        self.write_delay = write_delay
+        self._db = None
+        self._lock = threading.Lock()
+        self._dirty_users = {}
+        self._dirty_chats = {}
+        self._stored_chats = set()
+        self._dirty_conversations = {}
+        self._write_task = None
 
-def main():
-    """Главная функция для запуска бота."""
-    application = ApplicationBuilder().token(TOKEN).build()
+    def _execute(self, func):
+        with self._lock:
+            if self._db is None:
+                self._db = sqlite3.connect(self.path, check_same_thread=False)
+                self._db.executescript(self.SCHEMA)
+            return func(self._db)
 
-    # Добавление обработчика команды /start
-    application.add_handler(CommandHandler("start", start))
-    logger.debug("Обработчик /start добавлен.")
+    def _load(self, query, *args):
+        return self._execute(lambda db: db.execute(query, args).fetchall())
 
-    # Обработчик команды /get_repl_logs
-    application.add_handler(CommandHandler("get_repl_logs", get_repl_logs))
-    logger.debug("Обработчик /get_repl_logs добавлен.")
+    def _write(self, users, chats, conversations):
+        now = time.time()
 
-    # Обработчик команды /get_emails
-    get_emails_handler = CommandHandler('get_emails', get_emails_command)
-    application.add_handler(get_emails_handler)
-    logger.debug("Обработчик /get_emails добавлен.")
+        def write(db):
+            with db:
+                for table, column, rows in (('user_data', 'user_id', users), ('chat_data', 'chat_id', chats)):
+                    db.executemany(
+                        f'INSERT OR REPLACE INTO {table} VALUES (?, ?, ?)',
+                        [(key, data, now) for key, data in rows.items() if data is not None],
+                    )
+                    db.executemany(
+                        f'DELETE FROM {table} WHERE {column} = ?',
+                        [(key,) for key, data in rows.items() if data is None],
+                    )
+                db.executemany(
+                    'INSERT OR REPLACE INTO conversations VALUES (?, ?, ?, ?)',
+                    [(name, key, json.dumps(state), now)
+                     for (name, key), state in conversations.items() if state is not None],
+                )
+                db.executemany(
+                    'DELETE FROM conversations WHERE name = ? AND key = ?',
+                    [key for key, state in conversations.items() if state is None],
+                )
 
-    # Обработчик команды /get_phone_numbers
-    get_phone_numbers_handler = CommandHandler('get_phone_numbers', get_phone_numbers_command)
-    application.add_handler(get_phone_numbers_handler)
-    logger.debug("Обработчик /get_phone_numbers добавлен.")
+        self._execute(write)
 
-    # Добавление обработчика команды /get_release
-    application.add_handler(CommandHandler("get_release", get_release))
-    logger.debug("Обработчик /get_release добавлен.")
+    async def _write_dirty(self):
+        users, self._dirty_users = self._dirty_users, {}
+        chats, self._dirty_chats = self._dirty_chats, {}
+        conversations, self._dirty_conversations = self._dirty_conversations, {}
+        if users or chats or conversations:
+            await run_blocking(self._write, users, chats, conversations)
 
-    # Добавление обработчика команды /get_uname
-    application.add_handler(CommandHandler("get_uname", get_uname))
-    logger.debug("Обработчик /get_uname добавлен.")
+    async def _delayed_write(self):
+        # Изменения, пришедшие во время записи, записываются следующим проходом
+        while self._dirty_users or self._dirty_chats or self._dirty_conversations:
+            await asyncio.sleep(self.write_delay)
+            try:
+                await self._write_dirty()
+            except Exception:
+                logger.exception("Ошибка записи состояния в SQLite.")
 
-    # Добавление обработчика команды /get_uptime
-    application.add_handler(CommandHandler("get_uptime", get_uptime))
-    logger.debug("Обработчик /get_uptime добавлен.")
+    def _purge(self, now):
+        def purge(db):
+            with db:
+                users = db.execute('DELETE FROM user_data WHERE updated < ?', (now - USER_DATA_TTL,)).rowcount
+                conversations = db.execute(
+                    'DELETE FROM conversations WHERE updated < ?', (now - CONVERSATION_TIMEOUT,)
+                ).rowcount
+            return users, conversations
 
-    # Добавление обработчика команды /get_df
-    application.add_handler(CommandHandler("get_df", get_df))
-    logger.debug("Обработчик /get_df добавлен.")
+        return self._execute(purge)
 
-    # Добавление обработчика команды /get_free
-    application.add_handler(CommandHandler("get_free", get_free))
-    logger.debug("Обработчик /get_free добавлен.")
+    async def purge_expired(self):
+        """Удаляет записи, которые уже не восстанавливаются при загрузке; возвращает (user_data, диалогов)."""
+        return await run_blocking(self._purge, time.time())
 
-    # Добавление обработчика команды /get_mpstat
-    application.add_handler(CommandHandler("get_mpstat", get_mpstat))
-    logger.debug("Обработчик /get_mpstat добавлен.")
+    def _schedule_write(self):
+        if self._write_task is None or self._write_task.done():
+            self._write_task = asyncio.create_task(self._delayed_write())
 
-    # Добавление обработчика команды /get_w
-    application.add_handler(CommandHandler("get_w", get_w))
-    logger.debug("Обработчик /get_w добавлен.")
+    async def get_user_data(self):
+        rows = await run_blocking(
+            self._load, 'SELECT user_id, data FROM user_data WHERE updated >= ?', time.time() - USER_DATA_TTL
+        )
+        return {user_id: json.loads(data) for user_id, data in rows}
 
-    # Добавление обработчика команды /get_auths
-    application.add_handler(CommandHandler("get_auths", get_auths))
-    logger.debug("Обработчик /get_auths добавлен.")
+    async def get_chat_data(self):
+        rows = await run_blocking(self._load, 'SELECT chat_id, data FROM chat_data')
+        self._stored_chats = {chat_id for chat_id, _ in rows}
+        return {chat_id: json.loads(data) for chat_id, data in rows}
 
-    # Добавление обработчика команды /get_critical
-    application.add_handler(CommandHandler("get_critical", get_critical))
-    logger.debug("Обработчик /get_critical добавлен.")
+    async def get_bot_data(self):
+        return {}
 
-    # Добавление обработчика команды /get_services
-    application.add_handler(CommandHandler("get_services", get_services))
-    logger.debug("Обработчик /get_services добавлен.")
+    async def get_callback_data(self):
+        return None
 
-    # Добавление обработчика команды /get_ps
-    application.add_handler(CommandHandler("get_ps", get_ps))
-    logger.debug("Обработчик /get_ps добавлен.")
+    async def get_conversations(self, name):
+        rows = await run_blocking(
+            self._load, 'SELECT key, state FROM conversations WHERE name = ? AND updated >= ?',
+            name, time.time() - CONVERSATION_TIMEOUT,
+        )
+        return {tuple(json.loads(key)): json.loads(state) for key, state in rows}
 
-    # Добавление обработчика команды /get_ss
-    application.add_handler(CommandHandler("get_ss", get_ss))
-    logger.debug("Обработчик /get_ss добавлен.")
+    async def update_conversation(self, name, key, new_state):
+        self._dirty_conversations[(name, json.dumps(list(key)))] = new_state
+        self._schedule_write()
 
-    # Обработчик команды /find_email с использованием ConversationHandler
-    emails_conv = ConversationHandler(
-        entry_points=[CommandHandler('find_email', find_emails_command)],
-        states={
-            GET_EMAILS_TEXT: [MessageHandler(filters.TEXT & ~filters.COMMAND, receive_emails_text)],
-            CONFIRM_EMAIL: [MessageHandler(filters.TEXT & ~filters.COMMAND, confirm_emails)],
-        },
-        fallbacks=[CommandHandler('cancel', cancel)],
+    async def update_user_data(self, user_id, data):
+        self._dirty_users[user_id] = json.dumps(data, ensure_ascii=False)
+        self._schedule_write()
+
+    async def drop_user_data(self, user_id):
+        self._dirty_users[user_id] = None
+        self._schedule_write()
+
+    async def update_chat_data(self, chat_id, data):
+        if data:
+            self._stored_chats.add(chat_id)
+            self._dirty_chats[chat_id] = json.dumps(data, ensure_ascii=False)
+        else:
+            await self.drop_chat_data(chat_id)
+            return
+        self._schedule_write()
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        if chat_id not in self._stored_chats:
+            self._dirty_chats.pop(chat_id, None)
+            return
+        self._stored_chats.discard(chat_id)
+        self._dirty_chats[chat_id] = None
+        self._schedule_write()
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def flush(self):
+        if self._write_task is not None and not self._write_task.done():
+            self._write_task.cancel()
+        await self._write_dirty()
+        if self._db is not None:
+            await run_blocking(self._execute, lambda db: db.close())
+            self._db = None
+
+
+# Время последней активности пользователей для вытеснения устаревших user_data
+user_last_seen = {}
+
+async def track_user_activity(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Отмечает активность пользователя; выполняется до остальных обработчиков."""
+    if update.effective_user is not None:
+        user_last_seen[update.effective_user.id] = time.monotonic()
+
+async def evict_stale_user_data(context: ContextTypes.DEFAULT_TYPE):
+    """Удаляет user_data пользователей, не проявлявших активности дольше USER_DATA_TTL."""
+    application = context.application
+    now = time.monotonic()
+    evicted = 0
+    for user_id in set(application.user_data) | set(user_last_seen):
+        # Данные, восстановленные при запуске, отсчитывают срок с момента первой проверки
+        if now - user_last_seen.setdefault(user_id, now) <= USER_DATA_TTL:
+            continue
+        del user_last_seen[user_id]
+        if user_id in application.user_data:
+            application.drop_user_data(user_id)
+            evicted += 1
+    # chat_data создается при каждом обновлении; пустые записи не нужны
+    for chat_id in [chat_id for chat_id, data in application.chat_data.items() if not data]:
+        application.drop_chat_data(chat_id)
+    if evicted:
+        logger.info("Evicted stale user_data of %s users", evicted)
+    if isinstance(application.persistence, SQLitePersistence):
+        try:
+            users, conversations = await application.persistence.purge_expired()
+        except Exception:
+            logger.exception("Ошибка очистки устаревших записей SQLite.")
+        else:
+            if users or conversations:
+                logger.info("Purged %s stale user_data rows and %s conversations", users, conversations)
+
+async def conversation_timeout(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Очищает незавершенные данные диалога по истечении CONVERSATION_TIMEOUT."""
+    for key in ('emails', 'phones', 'apt_targets', 'apt_refresh'):
+        context.user_data.pop(key, None)
+    if update.effective_chat is not None:
+        await context.bot.send_message(update.effective_chat.id, "Время ожидания ответа истекло, операция отменена.")
+
+async def create_db_pool():
+    asyncpg = await load_backend('asyncpg')
+    return await asyncpg.create_pool(
+        user=DB_USER,
+        password=DB_PASSWORD,
+        database=DB_DATABASE,
+        host=DB_HOST,
+        port=DB_PORT,
+        min_size=DB_POOL_MIN_SIZE,
+        max_size=DB_POOL_MAX_SIZE,
+        statement_cache_size=DB_STATEMENT_CACHE_SIZE,
+        command_timeout=DB_COMMAND_TIMEOUT,
     )
-    application.add_handler(emails_conv)
 
-    # Обработчик команды /find_phone_number с использованием ConversationHandler
-    phones_conv = ConversationHandler(
-        entry_points=[CommandHandler('find_phone_number', find_phone_numbers_command)],
+db_pool_lock = asyncio.Lock()
+
+async def get_db_pool(application):
+    """Возвращает общий пул соединений, создавая его при первом обращении к базе данных."""
+    pool = application.bot_data.get('db_pool')
+    if pool is None:
+        async with db_pool_lock:
+            pool = application.bot_data.get('db_pool')
+            if pool is None:
+                pool = application.bot_data['db_pool'] = await create_db_pool()
+                logger.info("Пул соединений с базой данных создан.")
+    return pool
+
+async def compact_contacts_table(conn, kind, table, column):
+    """Приводит записи таблицы к канонической форме и удаляет получившиеся дубликаты.
+
+    Таблица читается курсором пачками, отличающиеся от канонических значения
+    копируются во временную таблицу, после чего дубликаты удаляются и
+    остальные записи обновляются тремя запросами.
+    """
+    normalize = NORMALIZERS[kind]
+    async with conn.transaction():
+        await conn.execute(
+            'CREATE TEMP TABLE contact_map (original text PRIMARY KEY, canonical text NOT NULL) ON COMMIT DROP'
+        )
+        cursor = await conn.cursor(f'SELECT {column} FROM {table}')
+        while True:
+            chunk = await cursor.fetch(DB_EXPORT_CHUNK_SIZE)
+            if not chunk:
+                break
+            changed = []
+            for record in chunk:
+                canonical = normalize(record[0])
+                if canonical != record[0]:
+                    changed.append((record[0], canonical))
+            if changed:
+                await conn.copy_records_to_table('contact_map', records=changed)
+        # Временные таблицы не анализируются автоматически, а от статистики зависит план соединений
+        await conn.execute('ANALYZE contact_map')
+        # Каноническая форма уже есть в таблице - исходная запись лишняя
+        removed = await conn.execute(
+            f'DELETE FROM {table} t USING contact_map m WHERE t.{column} = m.original '
+            f'AND EXISTS (SELECT 1 FROM {table} x WHERE x.{column} = m.canonical)'
+        )
+        # Несколько написаний одного значения - оставляем одно (первое по порядку)
+        merged = await conn.execute(
+            f'DELETE FROM {table} t USING ('
+            f'SELECT original, row_number() OVER (PARTITION BY canonical ORDER BY original) AS n '
+            f'FROM contact_map) m WHERE t.{column} = m.original AND m.n > 1'
+        )
+        updated = await conn.execute(
+            f'UPDATE {table} t SET {column} = m.canonical FROM contact_map m WHERE t.{column} = m.original'
+        )
+    deleted = int(removed.split()[-1]) + int(merged.split()[-1])
+    return deleted, int(updated.split()[-1])
+
+async def compact_contacts():
+    """Разовая миграция: нормализация и дедупликация таблиц emails и phones.
+
+    Возвращает {таблица: (удалено, нормализовано)}.
+    """
+    results = {}
+    pool = await create_db_pool()
+    try:
+        async with pool.acquire() as conn:
+            for kind, table in CONTACT_TABLES.items():
+                deleted, updated = await compact_contacts_table(conn, kind, table['table'], table['column'])
+                logger.info("%s: удалено дубликатов %s, нормализовано записей %s", table['table'], deleted, updated)
+                results[table['table']] = (deleted, updated)
+    finally:
+        await pool.close()
+    return results
+
+async def post_init(application):
+    """Публикует меню команд и запускает сервер метрик.
+
+    Пул соединений с базой данных создается позже, при первой команде, которой он нужен.
+    """
+    try:
+        await application.bot.set_my_commands([(spec.name, spec.description) for spec in COMMANDS])
+    except Exception as e:
+        logger.warning("Не удалось обновить меню команд: %s", e)
+    if METRICS_PORT:
+        application.bot_data['metrics_server'] = await asyncio.start_server(
+            serve_metrics, METRICS_LISTEN, METRICS_PORT
+        )
+        logger.info("Метрики доступны на http://%s:%s/metrics", METRICS_LISTEN, METRICS_PORT)
+
+async def post_shutdown(application):
+    """Закрывает долгоживущие соединения при остановке бота."""
+    metrics_server = application.bot_data.pop('metrics_server', None)
+    if metrics_server is not None:
+        metrics_server.close()
+        await metrics_server.wait_closed()
+    db_pool = application.bot_data.pop('db_pool', None)
+    if db_pool is not None:
+        await db_pool.close()
+        logger.info("Пул соединений с базой данных закрыт.")
+    await inventory.close()
+    logger.info("SSH-соединения закрыты.")
+    blocking_executor.shutdown(wait=False, cancel_futures=True)
+    if _extract_executor is not None:
+        _extract_executor.shutdown(wait=False, cancel_futures=True)
+
+@dataclass(slots=True)
+class BotCommandSpec:
+    """Команда бота. Для диалогов states задает состояния ConversationHandler,
+    conversation - его имя в хранилище состояний."""
+    name: str
+    description: str
+    callback: object
+    states: dict = None
+    conversation: str = None
+
+
+# Реестр команд: по нему регистрируются обработчики, строятся справка /start и меню бота
+COMMANDS = [
+    BotCommandSpec('start', 'Запуск бота', start),
+    BotCommandSpec('cancel', 'Отмена текущей операции', cancel),
+    BotCommandSpec(
+        'find_phone_number', 'Поиск телефонных номеров в тексте или файле', find_phone_numbers_command,
         states={
-            GET_PHONES_TEXT: [MessageHandler(filters.TEXT & ~filters.COMMAND, receive_phones_text)],
+            GET_PHONES_TEXT: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, receive_phones_text),
+                MessageHandler(filters.Document.ALL, receive_phones_document),
+            ],
             CONFIRM_PHONE: [MessageHandler(filters.TEXT & ~filters.COMMAND, confirm_phones)],
         },
-        fallbacks=[CommandHandler('cancel', cancel)],
-    )
-    application.add_handler(phones_conv)
-
-    # Конфигурирование ConversationHandler для проверки пароля
-    password_conv = ConversationHandler(
-        entry_points=[CommandHandler('verify_password', verify_password_start)],
+        conversation='phones_conv',
+    ),
+    BotCommandSpec(
+        'find_email', 'Поиск Email-адресов в тексте или файле', find_emails_command,
         states={
-            VERIFY_PASSWORD: [MessageHandler(filters.TEXT & ~filters.COMMAND, verify_password)]
+            GET_EMAILS_TEXT: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, receive_emails_text),
+                MessageHandler(filters.Document.ALL, receive_emails_document),
+            ],
+            CONFIRM_EMAIL: [MessageHandler(filters.TEXT & ~filters.COMMAND, confirm_emails)],
         },
-        fallbacks=[CommandHandler('cancel', cancel)],
-    )
-    application.add_handler(password_conv)
-    # Конфигурирование ConversationHandler для /get_apt_list
-    apt_list_handler = ConversationHandler(
-        entry_points=[CommandHandler('get_apt_list', get_apt_list)],
+        conversation='emails_conv',
+    ),
+    BotCommandSpec(
+        'verify_password', 'Проверка сложности пароля', verify_password_start,
+        states={VERIFY_PASSWORD: [MessageHandler(filters.TEXT & ~filters.COMMAND, verify_password)]},
+        conversation='password_conv',
+    ),
+    BotCommandSpec('get_release', 'Информация о релизе', get_release),
+    BotCommandSpec('get_uname', 'Информация об архитектуре процессора, имени хоста системы и версии ядра', get_uname),
+    BotCommandSpec('get_uptime', 'Информация о времени работы', get_uptime),
+    BotCommandSpec('get_df', 'Информация о состоянии файловой системы', get_df),
+    BotCommandSpec('get_free', 'Информация о состоянии оперативной памяти', get_free),
+    BotCommandSpec('get_mpstat', 'Информация о производительности системы', get_mpstat),
+    BotCommandSpec('get_w', 'Информация о работающих в данной системе пользователях', get_w),
+    BotCommandSpec('get_auths', 'Информация о последних 10 входах в систему', get_auths),
+    BotCommandSpec('get_critical', 'Информация о последних 5 критических событиях', get_critical),
+    BotCommandSpec('get_ps', 'Информация о запущенных процессах', get_ps),
+    BotCommandSpec('get_ss', 'Информация об используемых портах', get_ss),
+    BotCommandSpec(
+        'get_apt_list', 'Информация об установленных пакетах', get_apt_list,
         states={
             APT_LIST_CHOICE: [MessageHandler(filters.TEXT & ~filters.COMMAND, apt_list_choice)],
             APT_PACKAGE_NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, apt_package_search)],
         },
-        fallbacks=[CommandHandler('cancel', cancel)],
+        conversation='apt_list_handler',
+    ),
+    BotCommandSpec('get_services', 'Информация о запущенных сервисах', get_services),
+    BotCommandSpec('get_health', 'Сводка состояния системы одним запросом', get_health),
+    BotCommandSpec('get_repl_logs', 'Вывод логов о репликации', get_repl_logs),
+    BotCommandSpec('get_emails', 'Вывод Email-адресов из таблицы', get_emails_command),
+    BotCommandSpec('get_phone_numbers', 'Вывод телефонных номеров из таблицы', get_phone_numbers_command),
+    BotCommandSpec('cache_stats', 'Статистика кэша команд', cache_stats),
+    BotCommandSpec('bot_stats', 'Метрики бота (для администраторов)', bot_stats),
+    BotCommandSpec('alerts', 'Оповещения о состоянии хостов: on [@хост], off, status', alerts_command),
+]
+
+@functools.cache
+def command_help():
+    """Текст справки /start по реестру команд (без разметки)."""
+    lines = [f"/{spec.name} - {spec.description}" for spec in COMMANDS]
+    lines.append("Системные команды принимают цель: @хост, @группа или @all")
+    return "\n".join(lines)
+
+def command_handlers(persistent, timeout_handlers):
+    """Обработчики команд из реестра: сначала диалоги, затем простые команды.
+
+    Диалоги идут первыми, чтобы /cancel внутри диалога попадал в его fallbacks,
+    а не в общий обработчик /cancel.
+    """
+    conversations, commands = [], []
+    for spec in COMMANDS:
+        entry_point = CommandHandler(spec.name, spec.callback)
+        if spec.states is None:
+            commands.append(entry_point)
+            continue
+        conversations.append(ConversationHandler(
+            entry_points=[entry_point],
+            states={ConversationHandler.TIMEOUT: timeout_handlers, **spec.states},
+            fallbacks=[CommandHandler('cancel', cancel)],
+            conversation_timeout=CONVERSATION_TIMEOUT,
+            name=spec.conversation,
+            persistent=persistent,
+        ))
+    return conversations + commands
+
+def build_application(builder=None):
+    """Создает приложение и регистрирует все обработчики.
+
+    Через builder можно передать заранее настроенный ApplicationBuilder,
+    например с подменой Bot API для нагрузочных тестов.
+    """
+    if builder is None:
+        builder = (
+            ApplicationBuilder()
+            .token(TOKEN)
+            # Размер пула соединений как у ApplicationBuilder по умолчанию
+            .request(MeasuredRequest(HTTPXRequest(connection_pool_size=256)))
+            .post_init(post_init)
+            .post_shutdown(post_shutdown)
+        )
+        if PERSISTENCE_PATH:
+            builder = builder.persistence(SQLitePersistence(PERSISTENCE_PATH))
+    application = builder.application_class(InstrumentedApplication).concurrent_updates(BOT_WORKERS).build()
+    persistent = application.persistence is not None
+
+    # Метрики: ошибки обработчиков и показатели пулов
+    application.add_error_handler(error_handler)
+
+    def db_gauges():
+        pool = application.bot_data.get('db_pool')
+        if pool is None:
+            return []
+        return [
+            ('db_pool_size', {}, pool.get_size()),
+            ('db_pool_idle', {}, pool.get_idle_size()),
+            ('db_pool_max', {}, pool.get_max_size()),
+        ]
+
+    metrics.add_gauge('ssh', ssh_gauges)
+    metrics.add_gauge('db', db_gauges)
+    metrics.add_gauge('limits', limiter_gauges)
+
+    # Учет активности пользователей и вытеснение устаревших user_data
+    application.add_handler(TypeHandler(Update, track_user_activity), group=-1)
+    if application.job_queue is not None:
+        application.job_queue.run_repeating(evict_stale_user_data, USER_DATA_SWEEP_INTERVAL)
+    else:
+        logger.warning("JobQueue недоступна: устаревшие user_data не будут вытесняться.")
+    timeout_handlers = [TypeHandler(Update, conversation_timeout)]
+
+    # Команды из реестра
+    application.add_handlers(command_handlers(persistent, timeout_handlers))
+    logger.debug("Добавлено обработчиков команд: %s.", len(COMMANDS))
+
+    # Навигация по страницам и выгрузка для /get_emails, /get_phone_numbers, /get_apt_list и длинных ответов
+    application.add_handler(CallbackQueryHandler(contacts_page_callback, pattern=r'^contacts:(emails|phones):(prev|next|all)$'))
+    application.add_handler(CallbackQueryHandler(packages_page_callback, pattern=r'^apt:\d+$'))
+    application.add_handler(CallbackQueryHandler(output_page_callback, pattern=r'^page:[\w-]+:(\d+|-|file)$'))
+    logger.debug("Обработчик навигации по таблицам добавлен.")
+
+    # Фоновый опрос хостов и оповещения
+    if MONITOR_INTERVAL > 0 and application.job_queue is not None:
+        application.job_queue.run_repeating(monitor_job, MONITOR_INTERVAL, first=1, name='monitor')
+    elif MONITOR_INTERVAL > 0:
+        logger.warning("JobQueue недоступна: фоновый опрос хостов выключен.")
+
+    return application
+
+def main():
+    """Главная функция для запуска бота."""
+    parser = argparse.ArgumentParser(description="Telegram-бот для мониторинга серверов и баз данных.")
+    parser.add_argument(
+        '--compact-db', action='store_true',
+        help="нормализовать и дедуплицировать существующие записи emails и phones и выйти",
     )
-    application.add_handler(apt_list_handler)
+    args = parser.parse_args()
+    if args.compact_db:
+        results = asyncio.run(compact_contacts())
+        sys.stdout.write(''.join(
+            f"{table}: удалено дубликатов {deleted}, нормализовано записей {updated}\n"
+            for table, (deleted, updated) in results.items()
+        ))
+        return
+    if BOT_MODE == 'webhook' and not WEBHOOK_URL:
+        raise SystemExit(
+            "BOT_MODE=webhook требует WEBHOOK_URL - внешний HTTPS-адрес, по которому Telegram "
+            "будет присылать обновления (например, https://bot.example.com)."
+        )
 
-    # Запуск бота (начало polling, бот будет слушать новые сообщения)
-    logger.info("Бот запущен и начинает polling.")
-    application.run_polling()
+    application = build_application()
+
+    # При остановке бот перестает принимать обновления и дожидается обработки уже полученных
+    if BOT_MODE == 'webhook':
+        webhook_url = f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}"
+        logger.info("Бот запущен в режиме webhook на %s:%s/%s.", WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH)
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=webhook_url,
+            secret_token=WEBHOOK_SECRET,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+        )
+    else:
+        # Запуск бота (начало polling, бот будет слушать новые сообщения)
+        logger.info("Бот запущен и начинает polling.")
+        application.run_polling()
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,806 @@
+"""Стенд для замеров производительности бота.
+
+Бот запускается против поддельного Bot API (FakeTelegramRequest), который
+отдает записанные или синтетические обновления и принимает ответы бота
+без обращения к серверам Telegram.
+
+Примеры:
+    python bot_bench.py transport --mode both --count 2000
+    python bot_bench.py transport --mode webhook --updates updates.jsonl --rate 500
+    python bot_bench.py latency --delay 2
+    python bot_bench.py fleet --hosts 50 --delay 0.5
+    python bot_bench.py limits --users 20 --per-user 30 --delay 0.5
+    python bot_bench.py load --count 2000 --max-p95 200 --max-startup 1500
+    python bot_bench.py parsers --processes 10000 --sockets 50000
+    python bot_bench.py extract --size-mb 256 --gzip
+    python bot_bench.py ingest --dsn postgresql://postgres@localhost/bench
+"""
+import argparse
+import asyncio
+import contextlib
+import functools
+import gzip
+import json
+import os
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import time
+
+import httpx
+from telegram.ext import ApplicationBuilder
+from telegram.request import BaseRequest
+
+import BD_bot
+
+BENCH_TOKEN = "123456:BENCH"
+BENCH_BOT = {"id": 123456, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+# Методы Bot API, на которые бот отвечает пользователю
+REPLY_METHODS = {"sendMessage", "sendDocument", "editMessageText"}
+
+
+def make_update(update_id, text, user_id=None):
+    """Синтетическое обновление с текстовым сообщением от отдельного пользователя."""
+    user_id = user_id or update_id
+    message = {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private"},
+        "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"},
+        "text": text,
+    }
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"update_id": update_id, "message": message}
+
+
+def load_updates(path, count, commands):
+    """Загружает записанные обновления (JSON Lines) или генерирует синтетические."""
+    if path:
+        with open(path, encoding="utf-8") as f:
+            return [json.loads(line) for line in f if line.strip()][:count or None]
+    return [make_update(i, commands[i % len(commands)]) for i in range(1, count + 1)]
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+class FakeTelegramRequest(BaseRequest):
+    """Поддельный Bot API: выдает обновления через getUpdates и фиксирует ответы бота."""
+
+    def __init__(self, updates=(), rate=0):
+        self.pending = []
+        self.sent_at = {}
+        self.latencies = []
+        self.latencies_by_command = {}
+        self.calls = {}
+        self.replies = 0
+        self.failed = 0
+        self.errors = {}
+        self.texts = []
+        self.expected = 0
+        self.done = asyncio.Event()
+        self._new_updates = asyncio.Event()
+        self._updates = list(updates)
+        self._rate = rate
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def feed(self, deliver):
+        """Отправляет обновления боту с заданной частотой (0 - без ограничений)."""
+        self.expected = len(self._updates)
+        interval = 1 / self._rate if self._rate else 0
+        for update in self._updates:
+            message = update.get("message", {})
+            command = (message.get("text") or "").split(" ", 1)[0]
+            self.sent_at[message.get("chat", {}).get("id")] = (time.perf_counter(), command)
+            await deliver(update)
+            if interval:
+                await asyncio.sleep(interval)
+
+    def fail(self, error):
+        """Учитывает обновление, которое не удалось доставить боту: ответа на него не будет."""
+        self.failed += 1
+        name = type(error).__name__
+        self.errors[name] = self.errors.get(name, 0) + 1
+        if self.expected and self.replies + self.failed >= self.expected:
+            self.done.set()
+
+    async def enqueue(self, update):
+        self.pending.append(update)
+        self._new_updates.set()
+
+    def _reply(self, method, params):
+        self.replies += 1
+        self.texts.append(params.get("text", ""))
+        sent = self.sent_at.pop(params.get("chat_id"), None)
+        if sent is not None:
+            started, command = sent
+            latency = time.perf_counter() - started
+            self.latencies.append(latency)
+            self.latencies_by_command.setdefault(command, []).append(latency)
+        if self.expected and self.replies + self.failed >= self.expected:
+            self.done.set()
+        if method == "editMessageText":
+            return True
+        return {
+            "message_id": self.replies,
+            "date": int(time.time()),
+            "chat": {"id": params.get("chat_id") or 1, "type": "private"},
+            "text": params.get("text", ""),
+        }
+
+    async def _get_updates(self, params):
+        offset = params.get("offset") or 0
+        self.pending = [u for u in self.pending if u["update_id"] >= offset]
+        if not self.pending:
+            self._new_updates.clear()
+            try:
+                await asyncio.wait_for(self._new_updates.wait(), timeout=params.get("timeout") or 1)
+            except asyncio.TimeoutError:
+                return []
+        return self.pending[: params.get("limit") or 100]
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        endpoint = url.rsplit("/", 1)[-1]
+        params = request_data.parameters if request_data else {}
+        self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+        if endpoint == "getMe":
+            result = BENCH_BOT
+        elif endpoint == "getUpdates":
+            result = await self._get_updates(params)
+        elif endpoint in REPLY_METHODS:
+            result = self._reply(endpoint, params)
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+
+class MockSSHPool:
+    """Подмена SSHPool: отдает заготовленный вывод после блокирующей задержки.
+
+    Задержка выполняется через time.sleep в пуле потоков бота, как и настоящие
+    вызовы paramiko, поэтому цикл событий в это время остается свободным.
+    """
+
+    def __init__(self, outputs=None, delay=0.0, delays=None):
+        self.outputs = outputs or {}
+        self.delay = delay
+        self.delays = delays or {}
+        self.calls = 0
+
+    async def run(self, command):
+        self.calls += 1
+        delay = self.delays.get(command, self.delay)
+        if delay:
+            await BD_bot.run_blocking(time.sleep, delay)
+        return 0, self.outputs.get(command, f"output of {command}"), ""
+
+    async def close(self):
+        pass
+
+
+class MockCursor:
+    def __init__(self, rows):
+        self._rows = rows
+
+    async def fetch(self, count):
+        chunk, self._rows = self._rows[:count], self._rows[count:]
+        return chunk
+
+
+class MockConnection:
+    """Соединение asyncpg в объеме, который использует бот: execute, cursor, COPY, транзакции."""
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    async def _wait(self):
+        self.pool.queries += 1
+        if self.pool.delay:
+            await asyncio.sleep(self.pool.delay)
+
+    async def execute(self, query, *args):
+        await self._wait()
+        if query.startswith("INSERT"):
+            values = args[0] if args else self.pool.staging
+            self.pool.staging = []
+            return f"INSERT 0 {len(set(values))}"
+        return "OK"
+
+    async def copy_records_to_table(self, table, records):
+        await self._wait()
+        self.pool.staging = [record[0] for record in records]
+
+    async def cursor(self, query, *args):
+        await self._wait()
+        return MockCursor([(value,) for value in self.pool.rows])
+
+    @contextlib.asynccontextmanager
+    async def transaction(self):
+        yield
+
+
+class MockDBPool:
+    """Подмена пула asyncpg: запросы выполняются за заданное время без сервера."""
+
+    def __init__(self, rows=(), delay=0.0, size=10):
+        self.rows = list(rows)
+        self.delay = delay
+        self.staging = []
+        self.queries = 0
+        self._size = size
+        self._connections = asyncio.Semaphore(size)
+        self.in_use = 0
+
+    @contextlib.asynccontextmanager
+    async def acquire(self):
+        async with self._connections:
+            self.in_use += 1
+            try:
+                yield MockConnection(self)
+            finally:
+                self.in_use -= 1
+
+    def get_size(self):
+        return self._size
+
+    def get_idle_size(self):
+        return self._size - self.in_use
+
+    def get_max_size(self):
+        return self._size
+
+    async def close(self):
+        pass
+
+
+def install_mock_hosts(names, groups=None, **pool_kwargs):
+    """Подменяет инвентарь бота хостами с MockSSHPool."""
+    pools = {name: MockSSHPool(**pool_kwargs) for name in names}
+    BD_bot.inventory = BD_bot.HostInventory(pools, groups or {}, names[0])
+    return pools
+
+
+def bench_application(fake, builder=None):
+    """Собирает приложение бота поверх поддельного Bot API."""
+    builder = builder or ApplicationBuilder()
+    builder = builder.token(BENCH_TOKEN).request(BD_bot.MeasuredRequest(fake)).get_updates_request(fake)
+    return BD_bot.build_application(builder)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def wait_replies(fake, timeout):
+    """Ждет ответов на все обновления; при таймауте отчет строится по полученным."""
+    try:
+        await asyncio.wait_for(fake.done.wait(), timeout)
+    except asyncio.TimeoutError:
+        print(f"Таймаут: получено {fake.replies} из {fake.expected} ответов")
+
+
+async def run_polling(updates, rate, timeout):
+    fake = FakeTelegramRequest(updates, rate)
+    application = bench_application(fake)
+    async with application:
+        await application.updater.start_polling(poll_interval=0, timeout=1)
+        await application.start()
+        started = time.perf_counter()
+        await fake.feed(fake.enqueue)
+        await wait_replies(fake, timeout)
+        elapsed = time.perf_counter() - started
+        await application.updater.stop()
+        await application.stop()
+    return fake, elapsed
+
+
+async def run_webhook(updates, rate, timeout, connections):
+    """Доставка обновлений POST-запросами, не более connections одновременно, как у Telegram."""
+    fake = FakeTelegramRequest(updates, rate)
+    application = bench_application(fake)
+    port = free_port()
+    limits = httpx.Limits(max_connections=connections, max_keepalive_connections=connections)
+    async with application, httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", limits=limits) as client:
+        await application.updater.start_webhook(listen="127.0.0.1", port=port, url_path="bench")
+        await application.start()
+        slots = asyncio.Semaphore(connections)
+        inflight = set()
+
+        async def send(update):
+            try:
+                response = await client.post("/bench", json=update)
+                response.raise_for_status()
+            except httpx.HTTPError as e:
+                fake.fail(e)
+            finally:
+                slots.release()
+
+        async def post(update):
+            await slots.acquire()
+            task = asyncio.create_task(send(update))
+            inflight.add(task)
+            task.add_done_callback(inflight.discard)
+
+        started = time.perf_counter()
+        await fake.feed(post)
+        await wait_replies(fake, timeout)
+        elapsed = time.perf_counter() - started
+        await asyncio.gather(*inflight)
+        await application.updater.stop()
+        await application.stop()
+    return fake, elapsed
+
+
+def report(title, fake, elapsed):
+    latencies = [v * 1000 for v in fake.latencies]
+    print(
+        f"{title}: {fake.replies} ответов за {elapsed:.2f} с, "
+        f"{fake.replies / elapsed:.0f} обновлений/с, "
+        f"задержка p50={percentile(latencies, 0.5):.1f} мс "
+        f"p95={percentile(latencies, 0.95):.1f} мс "
+        f"p99={percentile(latencies, 0.99):.1f} мс"
+    )
+    if fake.failed:
+        print(f"{title}: не доставлено {fake.failed} обновлений: {fake.errors}")
+
+
+async def run_latency(delay, fast_count, timeout):
+    """Один медленный обработчик и поток быстрых обновлений от других пользователей."""
+    install_mock_hosts(["default"], delays={BD_bot.MPSTAT_VIEW.command: delay})
+    updates = [make_update(1, "/get_mpstat refresh")]
+    updates += [make_update(i, "/start") for i in range(2, fast_count + 2)]
+    fake = FakeTelegramRequest(updates, rate=fast_count / (delay / 2))
+    application = bench_application(fake)
+    async with application:
+        await application.updater.start_polling(poll_interval=0, timeout=1)
+        await application.start()
+        await fake.feed(fake.enqueue)
+        await wait_replies(fake, timeout)
+        await application.updater.stop()
+        await application.stop()
+    return fake
+
+
+def latency_command(args):
+    """Проверка, что медленный обработчик не задерживает остальные обновления."""
+    fake = asyncio.run(run_latency(args.delay, args.count, args.timeout))
+    slow = fake.latencies_by_command.get("/get_mpstat", [])
+    fast = [v * 1000 for v in fake.latencies_by_command.get("/start", [])]
+    p95 = percentile(fast, 0.95)
+    print(
+        f"/get_mpstat: {slow[0] * 1000 if slow else float('nan'):.0f} мс, "
+        f"/start во время его выполнения: p50={percentile(fast, 0.5):.1f} мс p95={p95:.1f} мс"
+    )
+    if not slow or p95 >= args.delay * 1000 / 2:
+        raise SystemExit("Быстрые обновления ждали медленный обработчик")
+
+
+def fleet_command(args):
+    """Параллельный опрос парка хостов через execute_on_hosts."""
+    names = [f"host{i:03d}" for i in range(args.hosts)]
+    pools = install_mock_hosts(names, delay=args.delay)
+    started = time.perf_counter()
+    results = asyncio.run(BD_bot.execute_on_hosts(names, "uptime -p"))
+    elapsed = time.perf_counter() - started
+    report_text = BD_bot.format_fleet_report(results)
+    print(
+        f"{len(results)} хостов за {elapsed:.2f} с "
+        f"(последовательно было бы {args.hosts * args.delay:.2f} с, "
+        f"FLEET_CONCURRENCY={BD_bot.FLEET_CONCURRENCY}), "
+        f"вызовов SSH: {sum(pool.calls for pool in pools.values())}, "
+        f"размер отчета: {len(report_text)} символов"
+    )
+
+
+def fake_ps_output(count):
+    lines = ["USER         PID %CPU %MEM    VSZ   RSS TTY      STAT START   TIME COMMAND"]
+    for pid in range(1, count + 1):
+        lines.append(
+            f"{random.choice(['root', 'postgres', 'www-data'])} {pid} {random.random() * 100:.1f} "
+            f"{random.random() * 10:.1f} {random.randint(1000, 10 ** 7)} {random.randint(100, 10 ** 6)} "
+            f"?        Ss   10:00   0:{random.randint(0, 59):02d} /usr/bin/worker --id {pid} --queue jobs"
+        )
+    return "\n".join(lines)
+
+
+def fake_ss_output(count):
+    lines = ["Netid State  Recv-Q Send-Q Local Address:Port Peer Address:Port Process"]
+    for i in range(count):
+        lines.append(
+            f"{random.choice(['tcp', 'udp'])} LISTEN 0 4096 10.{i % 256}.{i // 256 % 256}.1:{1024 + i % 60000} 0.0.0.0:*"
+        )
+    return "\n".join(lines)
+
+
+def fake_df_output(count):
+    lines = ["Filesystem     1024-blocks      Used Available Capacity Mounted on"]
+    for i in range(count):
+        size = random.randint(10 ** 6, 10 ** 9)
+        used = random.randint(0, size)
+        lines.append(f"/dev/sd{i} {size} {used} {size - used} {used * 100 // size}% /mnt/volume{i}")
+    return "\n".join(lines)
+
+
+def time_parser(name, parse, output, repeat, view=None, view_args=()):
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        records = parse(output)
+        best = min(best, time.perf_counter() - started)
+    line = (
+        f"{name}: {len(records)} записей, {len(output) / 2 ** 20:.1f} МБ, "
+        f"разбор {best * 1000:.1f} мс ({len(records) / best:,.0f} записей/с)"
+    )
+    if view is not None:
+        started = time.perf_counter()
+        BD_bot.apply_view(view, records, *view_args)
+        line += f", выборка {(time.perf_counter() - started) * 1000:.1f} мс"
+    print(line)
+
+
+async def run_limits(users, per_user, delay, timeout):
+    """Поток тяжелых команд от нескольких пользователей при медленном SSH."""
+    install_mock_hosts(["default"], delay=delay)
+    updates = [
+        make_update(n + 1, "/get_uptime refresh", user_id=n % users + 1)
+        for n in range(users * per_user)
+    ]
+    fake = FakeTelegramRequest(updates)
+    application = bench_application(fake)
+    async with application:
+        await application.updater.start_polling(poll_interval=0, timeout=1)
+        await application.start()
+        started = time.perf_counter()
+        await fake.feed(fake.enqueue)
+        await wait_replies(fake, timeout)
+        elapsed = time.perf_counter() - started
+        await application.updater.stop()
+        await application.stop()
+    return fake, elapsed
+
+
+def limits_command(args):
+    """Проверка ограничения частоты и допуска: лишние запросы получают быстрый отказ."""
+    fake, elapsed = asyncio.run(run_limits(args.users, args.per_user, args.delay, args.timeout))
+    limited = sum(text.startswith("Слишком много запросов") for text in fake.texts)
+    busy = sum(text.startswith("Бот занят") for text in fake.texts)
+    print(
+        f"{fake.replies} ответов за {elapsed:.2f} с: выполнено {fake.replies - limited - busy}, "
+        f"отказ по частоте {limited}, отказ по загрузке {busy}; "
+        f"корзины: {BD_bot.rate_limiter.stats()}, допуск: {BD_bot.admission.stats()}"
+    )
+
+
+# Запускается в отдельном интерпретаторе, чтобы измерить холодный импорт
+STARTUP_PROBE = """
+import json, sys, time
+started = time.perf_counter()
+import BD_bot
+imported = time.perf_counter()
+from telegram.ext import ApplicationBuilder
+BD_bot.build_application(ApplicationBuilder().token("123456:BENCH"))
+built = time.perf_counter()
+print(json.dumps({
+    "import": imported - started,
+    "build": built - imported,
+    "backends": sorted(name for name in ("paramiko", "asyncpg") if name in sys.modules),
+}))
+"""
+
+LOAD_COMMANDS = [
+    "/start", "/get_uptime", "/get_df", "/get_free", "/get_ps", "/get_ss",
+    "/get_emails", "/find_email", "/cache_stats",
+]
+
+
+def measure_startup(runs):
+    """Медианное время импорта BD_bot и сборки приложения в свежем интерпретаторе."""
+    path = os.pathsep.join(filter(None, [os.path.dirname(os.path.abspath(__file__)), os.getenv("PYTHONPATH")]))
+    env = {**os.environ, "PYTHONPATH": path, "PERSISTENCE_PATH": ""}
+    samples = []
+    for _ in range(runs):
+        result = subprocess.run([sys.executable, "-c", STARTUP_PROBE], env=env,
+                                capture_output=True, text=True, check=True)
+        samples.append(json.loads(result.stdout.splitlines()[-1]))
+    return (
+        statistics.median(sample["import"] for sample in samples),
+        statistics.median(sample["build"] for sample in samples),
+        samples[-1]["backends"],
+    )
+
+
+def fake_free_output():
+    return (
+        "               total        used        free      shared  buff/cache   available\n"
+        "Mem:        16303460     4523112     8123456      123456     3656892    11380348\n"
+        "Swap:        2097148      524288     1572860"
+    )
+
+
+async def run_load(updates, rate, ssh_delay, db_delay, rows, timeout):
+    """Смесь команд от разных пользователей против MockSSHPool и MockDBPool."""
+    random.seed(1)
+    outputs = {
+        BD_bot.DF_VIEW.command: fake_df_output(20),
+        BD_bot.FREE_VIEW.command: fake_free_output(),
+        BD_bot.PS_VIEW.command: fake_ps_output(300),
+        BD_bot.SS_VIEW.command: fake_ss_output(100),
+    }
+    install_mock_hosts(["default"], outputs=outputs, delay=ssh_delay)
+    fake = FakeTelegramRequest(updates, rate)
+    started = time.perf_counter()
+    application = bench_application(fake)
+    application.bot_data["db_pool"] = MockDBPool([f"user{i}@example.com" for i in range(rows)], db_delay)
+    async with application:
+        await application.updater.start_polling(poll_interval=0, timeout=1)
+        await application.start()
+        ready = time.perf_counter() - started
+        started = time.perf_counter()
+        await fake.feed(fake.enqueue)
+        await wait_replies(fake, timeout)
+        elapsed = time.perf_counter() - started
+        await application.updater.stop()
+        await application.stop()
+    return fake, ready, elapsed
+
+
+def load_command(args):
+    """Запуск, пропускная способность и задержки по обработчикам; пороги ловят регрессии."""
+    imported, built, backends = measure_startup(args.startup_runs)
+    print(
+        f"Запуск: импорт {imported * 1000:.0f} мс, сборка приложения {built * 1000:.0f} мс, "
+        f"загружено при запуске: {', '.join(backends) or 'ни paramiko, ни asyncpg'}"
+    )
+    BD_bot.metrics = BD_bot.Metrics()
+    # Очередь допуска вмещает все обновления прогона: отказы означают, что замер не удался
+    BD_bot.admission = BD_bot.AdmissionControl(
+        args.admission_limit, args.admission_queue or args.count, wait_timeout=args.timeout
+    )
+    updates = [make_update(i, args.commands[i % len(args.commands)]) for i in range(1, args.count + 1)]
+    fake, ready, elapsed = asyncio.run(run_load(updates, args.rate, args.delay, args.db_delay, args.rows, args.timeout))
+    print(f"Готовность к приему обновлений (сборка, initialize, start): {ready * 1000:.0f} мс")
+    report("Нагрузка", fake, elapsed)
+    limited = sum(text.startswith("Слишком много запросов") for text in fake.texts)
+    busy = sum(text.startswith("Бот занят") for text in fake.texts)
+    executed = fake.replies - limited - busy
+    print(f"Выполнено {executed}, отказов: по частоте {limited}, по загрузке {busy}")
+    # При отказах гистограммы смешивают быстрые отказы с настоящими выполнениями
+    failures = []
+    if limited or busy:
+        failures.append(f"отказано {limited + busy} обновлениям, задержки обработчиков недостоверны")
+    print("Обработчики, мс (p50 / p95 / p99, число):")
+    totals = [(handler, histogram) for (handler, phase), histogram in BD_bot.metrics.histograms.items()
+              if phase == "total"]
+    for handler, histogram in sorted(totals, key=lambda item: -item[1].count):
+        p50, p95, p99 = (histogram.quantile(q) * 1000 for q in (0.5, 0.95, 0.99))
+        print(f"  {handler:<20} {p50:7.1f} / {p95:7.1f} / {p99:7.1f}, {histogram.count}")
+        if args.max_p95 and p95 > args.max_p95:
+            failures.append(f"{handler}: p95 {p95:.1f} мс > {args.max_p95} мс")
+    if args.max_startup and (imported + built) * 1000 > args.max_startup:
+        failures.append(f"запуск {(imported + built) * 1000:.0f} мс > {args.max_startup} мс")
+    rate = executed / elapsed if elapsed else 0
+    if args.min_rate and rate < args.min_rate:
+        failures.append(f"{rate:.0f} обновлений/с < {args.min_rate}")
+    if fake.replies < len(updates):
+        failures.append(f"получено {fake.replies} из {len(updates)} ответов")
+    if failures:
+        raise SystemExit("Регрессия: " + "; ".join(failures))
+
+
+def parsers_command(args):
+    """Скорость разбора больших выводов ps, ss и df."""
+    random.seed(args.seed)
+    time_parser("ps aux", BD_bot.parse_ps, fake_ps_output(args.processes), args.repeat,
+                BD_bot.PS_VIEW, ("cpu", 5, {}))
+    time_parser("ss -tuln", BD_bot.parse_ss, fake_ss_output(args.sockets), args.repeat,
+                BD_bot.SS_VIEW, (None, None, {"port": "5432"}))
+    time_parser("df -Pk", BD_bot.parse_df, fake_df_output(args.mounts), args.repeat,
+                BD_bot.DF_VIEW, ("use", 10, {}))
+
+
+def fake_corpus(size_mb):
+    """Текст, похожий на выгрузку логов, с вкраплениями адресов и телефонов."""
+    words = ["INFO", "ERROR", "request", "user", "session", "timeout", "db", "replica", "ok"]
+    lines = []
+    for i in range(20000):
+        line = " ".join(random.choices(words, k=8))
+        if i % 7 == 0:
+            line += f" contact user{i}@example{i % 50}.com"
+        if i % 11 == 0:
+            line += f" tel +7 (9{i % 100:02d}) {i % 1000:03d}-{i % 100:02d}-{i % 97:02d}"
+        lines.append(line)
+    block = ("\n".join(lines) + "\n").encode("utf-8")
+    return block * max(1, size_mb * 2 ** 20 // len(block))
+
+
+async def run_parallel_extract(data, documents):
+    kinds = ["emails", "phones"] * documents
+    return await asyncio.gather(*(BD_bot.extract_from_document(data, kind) for kind in kinds))
+
+
+def extract_command(args):
+    """Скорость извлечения email и телефонов из больших документов."""
+    random.seed(args.seed)
+    data = fake_corpus(args.size_mb)
+    size_mb = len(data) / 2 ** 20
+    if args.gzip:
+        data = gzip.compress(data, compresslevel=1)
+    for kind in ("emails", "phones"):
+        started = time.perf_counter()
+        groups = BD_bot.extract_matches(data, kind)
+        elapsed = time.perf_counter() - started
+        total = sum(sum(originals.values()) for originals in groups.values())
+        print(
+            f"{kind}: {size_mb:.0f} МБ{' (gzip)' if args.gzip else ''} за {elapsed:.2f} с, "
+            f"{size_mb / elapsed:.1f} МБ/с, совпадений {total}, уникальных {len(groups)}"
+        )
+    # Параллельная обработка нескольких документов в пуле процессов бота
+    started = time.perf_counter()
+    try:
+        results = asyncio.run(run_parallel_extract(data, args.documents))
+    finally:
+        if BD_bot._extract_executor is not None:
+            BD_bot._extract_executor.shutdown()
+            BD_bot._extract_executor = None
+    elapsed = time.perf_counter() - started
+    total_mb = size_mb * len(results)
+    print(f"пул процессов: {len(results)} документов, {total_mb:.0f} МБ за {elapsed:.2f} с, {total_mb / elapsed:.1f} МБ/с")
+
+
+BENCH_TABLE = "bench_contacts"
+
+
+async def time_ingest(conn, values, path):
+    """Вставка в пустую таблицу и повторная вставка тех же значений (все дубликаты)."""
+    await conn.execute(f"TRUNCATE {BENCH_TABLE}")
+    timings = []
+    for _ in range(2):
+        started = time.perf_counter()
+        if path == "executemany":
+            await conn.executemany(
+                f"INSERT INTO {BENCH_TABLE}(value) VALUES($1) ON CONFLICT DO NOTHING", [(v,) for v in values]
+            )
+        else:
+            await BD_bot.insert_values(conn, BENCH_TABLE, "value", values, bulk=path == "copy")
+        timings.append(time.perf_counter() - started)
+    return timings
+
+
+async def run_ingest(dsn, sizes, paths):
+    import asyncpg
+
+    conn = await asyncpg.connect(dsn)
+    try:
+        await conn.execute(f"CREATE TABLE IF NOT EXISTS {BENCH_TABLE} (value text PRIMARY KEY)")
+        for size in sizes:
+            values = [f"+7{9000000000 + i}" for i in range(size)]
+            for path in paths:
+                first, again = await time_ingest(conn, values, path)
+                print(
+                    f"{size:>8} строк, {path:<11}: новые {first:.3f} с ({size / first:,.0f} строк/с), "
+                    f"дубликаты {again:.3f} с"
+                )
+        await conn.execute(f"DROP TABLE {BENCH_TABLE}")
+    finally:
+        await conn.close()
+
+
+def ingest_command(args):
+    """Сравнение построчной вставки, вставки массивом и COPY на локальном PostgreSQL."""
+    asyncio.run(run_ingest(args.dsn, args.sizes, args.paths))
+
+
+def transport_command(args):
+    """Сравнение пропускной способности polling и webhook."""
+    updates = load_updates(args.updates, args.count, args.commands)
+    modes = ["polling", "webhook"] if args.mode == "both" else [args.mode]
+    runners = {
+        "polling": run_polling,
+        "webhook": functools.partial(run_webhook, connections=args.connections),
+    }
+    failed = []
+    for mode in modes:
+        fake, elapsed = asyncio.run(runners[mode](updates, args.rate, args.timeout))
+        report(mode, fake, elapsed)
+        if fake.failed:
+            failed.append(mode)
+    if failed:
+        raise SystemExit(f"Часть обновлений не доставлена боту: {', '.join(failed)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    transport = subparsers.add_parser("transport", help="polling против webhook")
+    transport.add_argument("--mode", choices=["polling", "webhook", "both"], default="both")
+    transport.add_argument("--updates", help="файл с записанными обновлениями (JSON Lines)")
+    transport.add_argument("--count", type=int, default=1000)
+    transport.add_argument("--rate", type=float, default=0, help="обновлений в секунду, 0 - без ограничений")
+    transport.add_argument("--timeout", type=float, default=120)
+    transport.add_argument("--commands", nargs="+", default=["/start", "/cache_stats"])
+    transport.add_argument("--connections", type=int, default=BD_bot.WEBHOOK_MAX_CONNECTIONS,
+                           help="одновременных POST-запросов к webhook")
+    transport.set_defaults(func=transport_command)
+
+    latency = subparsers.add_parser("latency", help="влияние медленного обработчика на остальные")
+    latency.add_argument("--delay", type=float, default=2.0, help="длительность медленной SSH-команды, с")
+    latency.add_argument("--count", type=int, default=200, help="число быстрых обновлений")
+    latency.add_argument("--timeout", type=float, default=60)
+    latency.set_defaults(func=latency_command)
+
+    fleet = subparsers.add_parser("fleet", help="параллельный опрос парка хостов")
+    fleet.add_argument("--hosts", type=int, default=50)
+    fleet.add_argument("--delay", type=float, default=0.5, help="длительность команды на хосте, с")
+    fleet.set_defaults(func=fleet_command)
+
+    limits = subparsers.add_parser("limits", help="ограничение частоты и допуск тяжелых команд")
+    limits.add_argument("--users", type=int, default=20)
+    limits.add_argument("--per-user", type=int, default=30)
+    limits.add_argument("--delay", type=float, default=0.5, help="длительность SSH-команды, с")
+    limits.add_argument("--timeout", type=float, default=120)
+    limits.set_defaults(func=limits_command)
+
+    load = subparsers.add_parser("load", help="запуск, пропускная способность и задержки по обработчикам")
+    load.add_argument("--count", type=int, default=2000)
+    load.add_argument("--commands", nargs="+", default=LOAD_COMMANDS)
+    load.add_argument("--rate", type=float, default=0, help="обновлений в секунду, 0 - без ограничений")
+    load.add_argument("--admission-limit", type=int, default=BD_bot.ADMISSION_LIMIT)
+    load.add_argument("--admission-queue", type=int, default=0, help="очередь допуска, 0 - по числу обновлений")
+    load.add_argument("--delay", type=float, default=0.01, help="длительность SSH-команды, с")
+    load.add_argument("--db-delay", type=float, default=0.002, help="длительность запроса к базе, с")
+    load.add_argument("--rows", type=int, default=1000, help="записей в поддельных таблицах")
+    load.add_argument("--startup-runs", type=int, default=3)
+    load.add_argument("--timeout", type=float, default=120)
+    load.add_argument("--max-p95", type=float, default=0, help="порог p95 любого обработчика, мс")
+    load.add_argument("--max-startup", type=float, default=0, help="порог импорта и сборки, мс")
+    load.add_argument("--min-rate", type=float, default=0, help="порог обновлений в секунду")
+    load.set_defaults(func=load_command)
+
+    parsers = subparsers.add_parser("parsers", help="скорость разбора вывода команд")
+    parsers.add_argument("--processes", type=int, default=10000)
+    parsers.add_argument("--sockets", type=int, default=50000)
+    parsers.add_argument("--mounts", type=int, default=1000)
+    parsers.add_argument("--repeat", type=int, default=5)
+    parsers.add_argument("--seed", type=int, default=1)
+    parsers.set_defaults(func=parsers_command)
+
+    extract = subparsers.add_parser("extract", help="скорость извлечения email и телефонов")
+    extract.add_argument("--size-mb", type=int, default=256)
+    extract.add_argument("--gzip", action="store_true", help="сжать корпус, как загруженный .gz")
+    extract.add_argument("--documents", type=int, default=2, help="документов каждого типа для пула процессов")
+    extract.add_argument("--seed", type=int, default=1)
+    extract.set_defaults(func=extract_command)
+
+    ingest = subparsers.add_parser("ingest", help="скорость сохранения email/телефонов в PostgreSQL")
+    ingest.add_argument("--dsn", required=True, help="строка подключения к тестовой базе")
+    ingest.add_argument("--sizes", type=int, nargs="+", default=[100, 10000, 1000000])
+    ingest.add_argument("--paths", nargs="+", choices=["executemany", "array", "copy"],
+                        default=["executemany", "array", "copy"])
+    ingest.set_defaults(func=ingest_command)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()